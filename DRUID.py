@@ -37,6 +37,13 @@ parser.add_argument('--FDR', action='store_true')
 parser.add_argument('--useERSA', action="store_true", dest="useERSA", help="use the ERSA method to infer the initial pairwise relatedness.")
 parser.add_argument('--accu', action="store_true")
 parser.add_argument('--alpha', action="store", type=float, default=0.05, help="alpha for bonferroni correction or false discovery rate for FDR. Default to 0.05.")
+parser.add_argument('--cache', type=str, dest='cache', default='', help='Directory for caching parsed map/IBD files; later runs on unchanged inputs load them from here instead of re-parsing', metavar='DIR')
+parser.add_argument('--lazySegs', type=int, dest='lazySegs', default=0, help='Read the segments of a pair from the .seg file only when needed, keeping at most N pairs in memory; default is 0 (load all segments up front)', metavar='N')
+parser.add_argument('--minK', type=float, dest='minK', default=0, help='Treat pairs with kinship coefficient below K as unrelated and do not load their IBD segments; default is 0 (keep all pairs)', metavar='K')
+parser.add_argument('--sparse', action='store_true', dest='sparse', help='Only compare pairs that share IBD or are connected through inferred/provided relatives, instead of all pairs of individuals; pairs not compared are not written to the output')
+parser.add_argument('--schedule', action='store_true', dest='schedule', help='Compare pairs family by family (pairs within each family first, then pairs of families) instead of in sample order, so relationships propagated through the graph cover more of the pairs')
+parser.add_argument('--maxPathLen', type=int, dest='maxPathLen', default=10, help='Longest path (number of first/second degree relationships) between two individuals in the reconstructed graph that is used to type their relationship; more distant pairs are inferred from IBD. 0 for no limit; default is 10', metavar='N')
+parser.add_argument('--threads', type=int, dest='threads', default=1, help='Number of processes used to read the hapIBD file and to run the main inference (over independent groups of related individuals); with N > 1 the output lines are the same but in a different order; default is 1', metavar='N')
 args=parser.parse_args()
 
 inds = []
@@ -58,7 +65,7 @@ else:
 
 # Get map info
 global total_genome, chrom_name_to_idx, chrom_idx_to_name, chrom_starts, chrom_ends, num_chrs
-[total_genome, chrom_name_to_idx, chrom_idx_to_name, chrom_starts, chrom_ends, num_chrs, snp_map] = getChrInfo(args.m[0])
+[total_genome, chrom_name_to_idx, chrom_idx_to_name, chrom_starts, chrom_ends, num_chrs, snp_map, genome] = getChrInfo(args.m[0], args.cache)
 print("Genome length: " + str(total_genome)+'\n')
 print(f'chrom length: {np.array(chrom_ends)-np.array(chrom_starts)}')
 global founder, mean_seg_num, mean_ibd_amount
@@ -80,13 +87,13 @@ else:
 hapibd_segs = None
 hapibd_isCensored = None
 if args.hapibd:
-    hapibd_segs, hapibd_isCensored, all_segs, all_rel, inds, first, second, third = \
-            readHapIBD2(args.hapibd, snp_map, chrom_name_to_idx.keys(), args.u[0])
+    hapibd_segs, hapibd_isCensored, all_segs, all_rel, samples, inds, first, second, third = \
+            readHapIBD2(args.hapibd, snp_map, args.u[0], mean_ibd_amount, args.m[0], args.cache, args.threads, args.minK)
 else:
     assert args.i != None
     assert args.s != None
-    all_segs = readSegments(args.s[0])
-    all_rel, inds, first, second, third = getAllRel(args.i[0], args.u[0], mean_ibd_amount, total_genome)
+    all_rel, samples, inds, first, second, third = getAllRel(args.i[0], args.u[0], mean_ibd_amount, total_genome, args.cache, args.minK)
+    all_segs = readSegments(args.s[0], args.m[0], samples, args.cache, args.lazySegs, all_rel.keys if args.minK else None)
 
 print("Total number of individuals: " + str(len(inds)))
 
@@ -100,11 +107,12 @@ if args.useERSA:
         ersa_bonferroni(all_rel, hapibd_segs, hapibd_isCensored, args.minIBD, args.alpha)
 
 #make graph
+setMaxPathLength(args.maxPathLen)
 rel_graph = nx.DiGraph()
 rel_graph_tmp = nx.DiGraph()
 if args.f[0] != '':
     print("Reading in family info")
-    faminfo = getFamInfo(args.f[0], inds)
+    faminfo = getFamInfo(args.f[0], samples)
     forceFamInfo(rel_graph_tmp, faminfo) #store relationship information in rel_graph_tmp
 
 print("\nInferring first degree relatives")
@@ -120,14 +128,14 @@ outfile_results = open(args.o[0]+'.DRUID','w')
 outfile_results.write("#ind1\tind2\tDRUID\tRefinedIBD\tMethod\n")
 
 print("\n\nRunning main DRUID inference")
-runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile_results, snp_map, args.accu, mean_ibd_amount)
+runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile_results, genome, args.accu, mean_ibd_amount)
 
 outfile_results.close()
 
 
 if args.F[0] == 1:
     print("\nPrinting .fam files")
-    fillInGraph(rel_graph)
+    fillInGraph(nx.relabel_nodes(rel_graph, samples.name))
 
 print("\ndone")
 
@@ -1,89 +1,126 @@
-def getIBD1(ind1, ind2, all_rel):
-    if ind1 < ind2:
-        i1 = ind1
-        i2 = ind2
-    else:
-        i1 = ind2
-        i2 = ind1
+import numpy as np
+from DRUID_samples import *
 
-    if not i1 in all_rel.keys():
-        return 0
-    elif not i2 in all_rel[i1].keys():
+# one record per related pair; ind1/ind2 are sample codes with ind1 < ind2
+PAIR_DTYPE = np.dtype([('ind1', np.int32), ('ind2', np.int32), ('IBD1', np.float32), ('IBD2', np.float32),
+                       ('K', np.float32), ('D', np.int8)])
+
+
+class PairTable(object):
+    # pairwise relatedness [IBD1, IBD2, K, D] of all pairs read from the IBD files, replacing the old
+    # dict of ind1 -> dict of ind2 -> list; records are sorted by pair key so a lookup is a single binary search
+    def __init__(self, samples, records):
+        self.samples = samples #SampleIndex the ind1/ind2 codes refer to
+        self.records = records #PAIR_DTYPE, sorted by key
+        self.keys = packPairKeys(records['ind1'], records['ind2']) #int64, sorted
+        self.added = {} #pair key -> [IBD1, IBD2, K, D] of pairs set after the table was built
+        self.d_log = None #when a list, setD also appends (ind1, ind2, D) to it
+
+    def __len__(self):
+        return len(self.records) + len(self.added)
+
+    def pairRow(self, key):
+        # row of the record with pair key key, None if the pair is not in the table
+        k = self.keys.searchsorted(key)
+        if k == len(self.keys) or self.keys[k] != key:
+            return None
+        return k
+
+    def get(self, ind1, ind2):
+        # (IBD1, IBD2, K, D) of ind1 and ind2, None if they are not a related pair
+        key = getPairKey(ind1, ind2)
+        if self.added:
+            rel = self.added.get(key)
+            if rel is not None:
+                return rel
+        k = self.pairRow(key)
+        if k is None:
+            return None
+        return self.records[k].item()[2:]
+
+    def setD(self, ind1, ind2, D):
+        # update the degree of ind1 and ind2; a pair not in the table is added with IBD1 = IBD2 = K = 0
+        if self.d_log is not None:
+            self.d_log.append((ind1, ind2, D))
+        key = getPairKey(ind1, ind2)
+        if key in self.added:
+            self.added[key][3] = D
+            return
+        k = self.pairRow(key)
+        if k is None:
+            self.added[key] = [0, 0, 0, D]
+        else:
+            self.records['D'][k] = D
+
+    def pairs(self, min_D=None):
+        # iterate (ind1, ind2, D) over all pairs, or only those with degree > min_D
+        rows = np.arange(len(self.records)) if min_D is None else np.flatnonzero(self.records['D'] > min_D)
+        yield from zip(self.records['ind1'][rows].tolist(), self.records['ind2'][rows].tolist(),
+                       self.records['D'][rows].tolist())
+        for key, rel in list(self.added.items()):
+            if min_D is None or rel[3] > min_D:
+                yield key >> 32, key & 0xffffffff, rel[3]
+
+
+def buildPairTable(samples, ind1, ind2, ibd1, ibd2, K, D):
+    # build a PairTable from per-pair columns of sample codes; a pair listed more than once keeps its last record
+    ind1 = np.asarray(ind1, dtype=np.int64)
+    ind2 = np.asarray(ind2, dtype=np.int64)
+    num_pairs = len(ind1)
+    keys = packPairKeys(ind1, ind2)
+
+    # reversed, so np.unique picks the last occurrence of each key
+    _, last = np.unique(keys[::-1], return_index=True)
+    rows = num_pairs - 1 - last
+    records = np.empty(len(rows), dtype=PAIR_DTYPE)
+    records['ind1'] = np.minimum(ind1, ind2)[rows]
+    records['ind2'] = np.maximum(ind1, ind2)[rows]
+    records['IBD1'] = np.asarray(ibd1)[rows]
+    records['IBD2'] = np.asarray(ibd2)[rows]
+    records['K'] = np.asarray(K)[rows]
+    records['D'] = np.asarray(D)[rows]
+    return PairTable(samples, records)
+
+
+def getIBD1(ind1, ind2, all_rel):
+    rel = all_rel.get(ind1, ind2)
+    if rel is None:
         return 0
     else:
-        return all_rel[i1][i2][0]
+        return rel[0]
 
 
 def getIBD2(ind1, ind2, all_rel):
-    if ind1 < ind2:
-        i1 = ind1
-        i2 = ind2
-    else:
-        i1 = ind2
-        i2 = ind1
-
-    if not i1 in all_rel.keys():
-        return 0
-    elif not i2 in all_rel[i1].keys():
+    rel = all_rel.get(ind1, ind2)
+    if rel is None:
         return 0
     else:
-        return all_rel[i1][i2][1]
+        return rel[1]
 
 
 def getPairwiseK(ind1, ind2, all_rel):
-    if ind1 < ind2:
-        i1 = ind1
-        i2 = ind2
-    else:
-        i1 = ind2
-        i2 = ind1
-
-    if not i1 in all_rel.keys():
-        return 0
-    elif not i2 in all_rel[i1].keys():
+    rel = all_rel.get(ind1, ind2)
+    if rel is None:
         return 0
     else:
-        return all_rel[i1][i2][2]
+        return rel[2]
 
 
 def getPairwiseD(ind1, ind2, all_rel):
-    if ind1 < ind2:
-        i1 = ind1
-        i2 = ind2
-    else:
-        i1 = ind2
-        i2 = ind1
-
-    if not i1 in all_rel.keys():
-        return -1
-    elif not i2 in all_rel[i1].keys():
+    rel = all_rel.get(ind1, ind2)
+    if rel is None:
         return -1
     else:
-        return all_rel[i1][i2][3]
+        return rel[3]
 
 
-def getPairD_w_Name(ind1, ind2, all_rel):
-    if ind1 < ind2:
-        pair_name = ind1 + "$" + ind2
-        i1 = ind1
-        i2 = ind2
-    else:
-        pair_name = ind2 + "$" + ind1
-        i1 = ind2
-        i2 = ind1
-
-    if not i1 in all_rel.keys():
-        return (-1, pair_name)
-    elif not i2 in all_rel[i1].keys():
-        return (-1, pair_name)
-    else:
-        return (all_rel[i1][i2][3], pair_name)
+def getPairD_w_Key(ind1, ind2, all_rel):
+    return (getPairwiseD(ind1, ind2, all_rel), getPairKey(ind1, ind2))
 
 
-def getPairName(ind1, ind2):
+def getPairKey(ind1, ind2):
+    # packed int64 key of an unordered pair of sample codes, see DRUID_samples.packPairKeys
     if ind1 < ind2:
-        pair_name = ind1 + "$" + ind2
-        return pair_name
+        return ind1 << 32 | ind2
     else:
-        pair_name = ind2 + "$" + ind1
-        return pair_name
+        return ind2 << 32 | ind1
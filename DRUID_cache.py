@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+CACHE_VERSION = 3
+
+
+def fileFingerprint(path):
+    # identify an input file by its path, size, modification time and a hash of its content
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    content_hash = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            content_hash.update(chunk)
+    return [path, stat.st_size, stat.st_mtime_ns, content_hash.hexdigest()]
+
+
+def arraysFingerprint(*arrays):
+    # hash of the content of some arrays (e.g. the samples or pairs a parse was restricted to), for cache params
+    content_hash = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        content_hash.update(str(array.dtype).encode())
+        content_hash.update(array.tobytes())
+    return content_hash.hexdigest()
+
+
+def cacheKey(kind, input_files, params):
+    # key of a cache entry: what was parsed, from which inputs, with which parse options
+    description = {
+        'version': CACHE_VERSION,
+        'kind': kind,
+        'inputs': [fileFingerprint(path) for path in input_files if path != ''],
+        'params': params,
+    }
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest(), description
+
+
+def loadCachedArrays(cache_dir, kind, input_files, params, build):
+    # return the dict of name -> array produced by build()
+    # with a cache directory, arrays are stored as .npy files next to a small index.json, and a later
+    # call with unchanged inputs memory-maps them instead of calling build() again
+    if not cache_dir:
+        return build()
+
+    key, description = cacheKey(kind, input_files, params)
+    entry = os.path.join(cache_dir, kind + '-' + key)
+    index_file = os.path.join(entry, 'index.json')
+    if os.path.isfile(index_file):
+        with open(index_file, 'r') as file:
+            index = json.load(file)
+        print(f'Using cached {kind} from {entry}')
+        return { name : np.load(os.path.join(entry, name + '.npy'), mmap_mode='r') for name in index['arrays'] }
+
+    arrays = build()
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_entry = tempfile.mkdtemp(prefix=kind + '-', dir=cache_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_entry, name + '.npy'), np.asarray(array), allow_pickle=False)
+    description['arrays'] = list(arrays.keys())
+    with open(os.path.join(tmp_entry, 'index.json'), 'w') as file:
+        json.dump(description, file, indent=1)
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError: #another run stored the same entry first
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    print(f'Cached {kind} in {entry}')
+    return arrays
@@ -1,21 +1,30 @@
+import bisect
 import itertools
 import networkx as nx
 import copy
 import gzip
+import io
+import multiprocessing
 import numpy as np
 import time
-from collections import defaultdict
+import weakref
+from collections import OrderedDict, deque
 from scipy.integrate import quad
 from scipy.special import logsumexp
 from concurrent import futures
-from numba import jit
 import scipy.stats
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from collections import namedtuple
 from operator import attrgetter
 from DRUID_graph_interaction import *
 from DRUID_all_rel import *
 from constant import *
 import ibd
+from DRUID_segments import *
+from DRUID_genome import *
+from DRUID_cache import *
+from DRUID_intervals import *
 import pandas as pd
 from collections import Counter
 from itertools import product
@@ -23,6 +32,11 @@ from itertools import product
 
 global total_genome, chrom_name_to_idx, chrom_idx_to_name, num_chrs, mean_seg_num, mean_ibd_amount
 MAX_ITER = 5
+COMBINE_CACHE_SIZE = 1 << 16 #family set pairs whose combineBothGPsKeepProportionOnlyExpectation result is kept
+STATE_TRACK_CACHE_BYTES = 256 << 20 #approximate memory the IBD state tracks of a StateTrackCache may use
+STATE_TRACK_BYTES = 200 #approximate memory of a state track, besides its chromosomes and intervals
+CHROMOSOME_TRACK_BYTES = 56 #approximate memory of the tuple of intervals of one chromosome of one IBD state
+INTERVAL_BYTES = 112 #approximate memory of one (start, end) interval of a state track
 degrees = {'MZ': 1/2.0**(3.0/2), 1: 1/2.0**(5.0/2), 2: 1/2.0**(7.0/2), 3: 1/2.0**(9.0/2), 4: 1/2.0**(11.0/2), 5: 1/2.0**(13.0/2), 6: 1/2.0**(15.0/2), 7: 1/2.0**(17.0/2), 8: 1/2.0**(19.0/2), 9: 1/2.0**(21.0/2), 10: 1/2.0**(23.0/2), 11: 1/2.0**(25.0/2), 12: 1/2.0**(27/2.0), 13: 1/2.0**(29.0/2)}  # threshold values for each degree of relatedness
 
 
@@ -30,8 +44,7 @@ def forceFamInfo(rel_graph, faminfo):
     #force the provided faminfo file information into rel_graph
     for i1 in faminfo.keys():
         for i2 in faminfo[i1].keys():
-            rel_graph.add_edge(i1,i2)
-            rel_graph[i1][i2]['type'] = faminfo[i1][i2]
+            setEdgeType(i1, i2, faminfo[i1][i2], rel_graph)
 
 
 def inferFirst(rel_graph, rel_graph_tmp, all_rel, first, second, C):
@@ -48,7 +61,7 @@ def inferFirst(rel_graph, rel_graph_tmp, all_rel, first, second, C):
         if ibd2 >= fs_IBD2 and kinship >= fs_kin: #if IBD2 meets minimum threshold
             if kinship < 1/2.0**(3/2.0): #not twin
                 if ibd2 < 1/2.0**(5/2.0): #lower IBD2 than expected
-                    print("Warning: " + i1 + ' and ' + i2 + ' have low levels of IBD2 for siblings, may be 3/4 sibs')
+                    print("Warning: " + samples.name(i1) + ' and ' + samples.name(i2) + ' have low levels of IBD2 for siblings, may be 3/4 sibs')
                 addEdgeType(i1, i2, 'FS', 'FS', rel_graph)
             else: #twin
                 addEdgeType(i1, i2, 'T', 'T', rel_graph)
@@ -74,8 +87,8 @@ def inferFirst(rel_graph, rel_graph_tmp, all_rel, first, second, C):
             for ind in remove:
                 for sib in siblings:
                     if rel_graph.has_edge(ind,sib):
-                        rel_graph[ind][sib]['type'] = '1U'
-                        rel_graph[sib][ind]['type'] = '1U'
+                        setEdgeType(ind, sib, '1U', rel_graph)
+                        setEdgeType(sib, ind, '1U', rel_graph)
                 if ind in siblings:
                     siblings.remove(ind)
 
@@ -137,12 +150,11 @@ def inferFirst(rel_graph, rel_graph_tmp, all_rel, first, second, C):
     # compare inferred graph to provided graph
     for edge in rel_graph_tmp.edges():
         if not edge in rel_graph.edges():
-            print("Warning: Unable to confirm " + edge[0] + " and " + edge[1] + " as " + str(rel_graph_tmp.get_edge_data(edge[0], edge[1])['type']) + " but including as such")
-            rel_graph.add_edge(edge[0],edge[1])
-            rel_graph[edge[0]][edge[1]]['type'] = rel_graph_tmp.get_edge_data(edge[0], edge[1])['type']
+            print("Warning: Unable to confirm " + samples.name(edge[0]) + " and " + samples.name(edge[1]) + " as " + str(rel_graph_tmp.get_edge_data(edge[0], edge[1])['type']) + " but including as such")
+            setEdgeType(edge[0], edge[1], rel_graph_tmp.get_edge_data(edge[0], edge[1])['type'], rel_graph)
         elif rel_graph_tmp.get_edge_data(edge[0], edge[1])['type'] != rel_graph.get_edge_data(edge[0], edge[1])['type']:
-            print("Warning: Unable to confirm " + edge[0] + " and " + edge[1] + " as " + str(rel_graph_tmp.get_edge_data(edge[0], edge[1])['type']) + " but including as such")
-            rel_graph[edge[0]][edge[1]]['type'] = rel_graph_tmp.get_edge_data(edge[0], edge[1])['type']
+            print("Warning: Unable to confirm " + samples.name(edge[0]) + " and " + samples.name(edge[1]) + " as " + str(rel_graph_tmp.get_edge_data(edge[0], edge[1])['type']) + " but including as such")
+            setEdgeType(edge[0], edge[1], rel_graph_tmp.get_edge_data(edge[0], edge[1])['type'], rel_graph)
 
     # #ensure sibsets have same relatives
     # for sibset in sibsets:
@@ -186,12 +198,10 @@ def readHapIBD(file_for_hapibd):
     return hapibd_segs, hapibd_isCensored
 
 
-def readHapIBD2(file_for_hapibd, snp_map, chrom_names, inds_file):
-    hapibd_segs = {}
-    hapibd_isCensored = {}
-    pairs = {}
-
-    global inds
+def readHapIBD2(file_for_hapibd, snp_map, inds_file, mean_ibd_amount, mapfile, cache_dir='', threads=1, min_K=0):
+    # pairs with an individual not in inds_file (if given) are dropped while parsing, and pairs with
+    # kinship coefficient below min_K once their IBD1/IBD2 totals are known
+    global inds, samples
     inds = set()
     if inds_file != '':
         file = open(inds_file,'r')
@@ -201,111 +211,243 @@ def readHapIBD2(file_for_hapibd, snp_map, chrom_names, inds_file):
                 inds.add(l[0])
         file.close()
 
-    start = time.time()
-    with gzip.open(file_for_hapibd, 'rt') as file:
-        line = file.readline()
-        while line:
-            ind1, _, ind2, _, chr, start_bp, end_bp, length = line.strip().split('\t')
-
-            if inds_file != "" and (ind1 not in inds or ind2 not in inds):
-                line = file.readline()
-                continue
-            elif inds_file == "":
-                inds.add(ind1)
-                inds.add(ind2)
-            
-            ids = (min(ind1, ind2), max(ind1, ind2))
-            start_bp, end_bp, length = int(start_bp), int(end_bp), float(length)
-
-            if (ids[0], ids[1]) not in pairs:
-                pairs[(ids[0], ids[1])] = ibd.pair(ids[0], ids[1], chrom_names, total_genome)
-            pairs[(ids[0], ids[1])].addIBDSeg(ibd.ibdSeg(start_bp, end_bp, snp_map[chr][start_bp], snp_map[chr][end_bp], chr, length))
-            
-            if not ids[0] in hapibd_segs:
-                hapibd_segs[ ids[0] ] = \
-                    { ids[1]: { chr : [] for chr in range(num_chrs) } }
-                hapibd_isCensored[ ids[0] ] = \
-                    { ids[1]: { chr : [] for chr in range(num_chrs) } }
-            elif not ids[1] in hapibd_segs[ ids[0] ]:
-                hapibd_segs[ ids[0] ][ ids[1] ] = \
-                                { chr : [] for chr in range(num_chrs) }
-                hapibd_isCensored[ ids[0] ][ ids[1] ] = \
-                                { chr : [] for chr in range(num_chrs) }
-
-            hapibd_segs[ids[0]][ids[1]][chrom_name_to_idx[chr]].append(length)
-            isCensored = start_bp == chrom_starts_bp[chrom_name_to_idx[chr]] or end_bp == chrom_ends_bp[chrom_name_to_idx[chr]]
-            hapibd_isCensored[ids[0]][ids[1]][chrom_name_to_idx[chr]].append(isCensored)
-
-            line = file.readline()
-    print(f'finished reading hapibd file, takes {time.time()-start}', flush=True)
-
-    first = [] #list of first degree relative pairs according to Refined IBD results
-    second = [] #list of second degree relative pairs according to Refined IBD results
-    third = [] #list of third degree relative pairs according to Refined IBD results
-
-    all_segs = {}
-    all_rel = defaultdict(lambda: {})
-    for pair, pair_obj in pairs.items():
-        ind1, ind2 = pair
-        if not ind1 in all_segs:
-            all_segs[ ind1 ] = \
-                    { ind2: [ { chr : [] for chr in range(num_chrs) } for _ in range(2) ] }
-        elif not ind2 in all_segs[ ind1 ]:
-            all_segs[ ind1 ][ ind2 ] = \
-                        [ { chr : [] for chr in range(num_chrs) } for _ in range(2) ]
-
-        ibd1 = ibd2 = 0
-        for chrom_name, interval_Tree in pair_obj.ibdList.items():
-            chr = chrom_name_to_idx[chrom_name]
-            for interval in interval_Tree.items():    
-                ibdSeg = interval[2]
-                IBD_status = 1 if ibdSeg.isIBD2 else 0
-                start_cM, end_cM = ibdSeg.start_cM, ibdSeg.end_cM
-                all_segs[ind1][ind2][IBD_status][chr].append([start_cM, end_cM])
-                if IBD_status:
-                    ibd2 += ibdSeg.length
-                else:
-                    ibd1 += ibdSeg.length
-
-        ibd1 /= total_genome
-        ibd2 /= total_genome
-        ibd1 = max(0, ibd1 - mean_ibd_amount / total_genome)
-        K = ibd1/4.0 + ibd2/2.0
-        degree = getInferredFromK(K)
-        all_rel[ind1][ind2] = [ibd1,ibd2, K, degree]
-        if degree == 1:
-            first.append([ind1,ind2])
-        elif degree == 2:
-            second.append([ind1,ind2])
-        elif degree == 3:
-            third.append([ind1, ind2])
-
-
-    return hapibd_segs, hapibd_isCensored, all_segs, all_rel, inds, first, second, third
+    # parsing depends on the map (cM, chromosome indices) and the -u list, so all three key a cached copy
+    hapibd_cols = loadCachedArrays(cache_dir, 'hapibd', [file_for_hapibd, mapfile, inds_file], {},
+                                   lambda: parseHapIBD(file_for_hapibd, snp_map, inds_file, threads))
+    if inds_file == '':
+        inds.update(hapibd_cols['inds'].tolist())
+    # from here on individuals are sample codes, see DRUID_samples.SampleIndex
+    samples = SampleIndex(inds)
+    inds = set(range(len(samples)))
+
+    pair_ind1, pair_ind2 = samples.codes(hapibd_cols['pair_ind1']), samples.codes(hapibd_cols['pair_ind2'])
+    ibd1 = hapibd_cols['pair_ibd1'] / total_genome
+    ibd2 = hapibd_cols['pair_ibd2'] / total_genome
+    ibd1 = np.maximum(0, ibd1 - mean_ibd_amount / total_genome)
+    K = ibd1/4.0 + ibd2/2.0
+    if min_K:
+        keep = K >= min_K
+        pair_ind1, pair_ind2, ibd1, ibd2, K = pair_ind1[keep], pair_ind2[keep], ibd1[keep], ibd2[keep], K[keep]
+    degree = getInferredFromKArray(K)
+
+    all_rel = buildPairTable(samples, pair_ind1, pair_ind2, ibd1, ibd2, K, degree)
+
+    first = np.column_stack((pair_ind1, pair_ind2))[degree == 1].tolist() #list of first degree relative pairs according to Refined IBD results
+    second = np.column_stack((pair_ind1, pair_ind2))[degree == 2].tolist() #list of second degree relative pairs according to Refined IBD results
+    third = np.column_stack((pair_ind1, pair_ind2))[degree == 3].tolist() #list of third degree relative pairs according to Refined IBD results
+
+    raw_ind1, raw_ind2 = samples.codes(hapibd_cols['raw_ind1']), samples.codes(hapibd_cols['raw_ind2'])
+    raw_rows = np.flatnonzero(np.isin(packPairKeys(raw_ind1, raw_ind2), all_rel.keys)) if min_K else slice(None)
+    hapibd_segs = {}
+    hapibd_isCensored = {}
+    for ind1, ind2, chr, length, isCensored in zip(raw_ind1[raw_rows].tolist(), raw_ind2[raw_rows].tolist(),
+                                                   hapibd_cols['raw_chrom'][raw_rows].tolist(), hapibd_cols['raw_length'][raw_rows].tolist(),
+                                                   hapibd_cols['raw_censored'][raw_rows].tolist()):
+        if not ind1 in hapibd_segs:
+            hapibd_segs[ ind1 ] = \
+                { ind2: { chr : [] for chr in range(num_chrs) } }
+            hapibd_isCensored[ ind1 ] = \
+                { ind2: { chr : [] for chr in range(num_chrs) } }
+        elif not ind2 in hapibd_segs[ ind1 ]:
+            hapibd_segs[ ind1 ][ ind2 ] = \
+                            { chr : [] for chr in range(num_chrs) }
+            hapibd_isCensored[ ind1 ][ ind2 ] = \
+                            { chr : [] for chr in range(num_chrs) }
+
+        hapibd_segs[ind1][ind2][chr].append(length)
+        hapibd_isCensored[ind1][ind2][chr].append(isCensored)
+
+
+    all_segs = segmentStoreFromArrays(hapibd_cols, num_chrs, prefix='seg_').withSamples(samples, all_rel.keys if min_K else None)
+    return hapibd_segs, hapibd_isCensored, all_segs, all_rel, samples, inds, first, second, third
+
+
+HAPIBD_BLOCK_SIZE = 64 << 20 #bytes of decompressed hapIBD text parsed per task
+
+
+def readHapIBDBlocks(file_for_hapibd, block_size=HAPIBD_BLOCK_SIZE):
+    # yield the decompressed hapIBD file in blocks of about block_size bytes, each ending at a line break
+    with gzip.open(file_for_hapibd, 'rb') as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            yield block + file.readline()
+
+
+def parseHapIBDBlock(block, inds, chrom_name_to_idx):
+    # parse one block of hapIBD lines into arrays; if inds is given, drop pairs with an individual not in it
+    # IDs (and their haplotypes) are swapped so that ind1 < ind2
+    hap_ibd = pd.read_csv(io.BytesIO(block), sep='\t', header=None,
+                          names=['ind1', 'hap1', 'ind2', 'hap2', 'chr', 'start_bp', 'end_bp', 'length'],
+                          dtype={'ind1': str, 'hap1': np.int8, 'ind2': str, 'hap2': np.int8, 'chr': str,
+                                 'start_bp': np.int64, 'end_bp': np.int64, 'length': np.float64},
+                          float_precision='round_trip')
+    if inds is not None:
+        hap_ibd = hap_ibd[hap_ibd['ind1'].isin(inds) & hap_ibd['ind2'].isin(inds)]
+    chrom = hap_ibd['chr'].map(chrom_name_to_idx)
+    if chrom.isna().any():
+        raise KeyError(hap_ibd['chr'][chrom.isna()].iloc[0])
+
+    ind1, ind2 = hap_ibd['ind1'].to_numpy(dtype=object), hap_ibd['ind2'].to_numpy(dtype=object)
+    hap1, hap2 = hap_ibd['hap1'].to_numpy(), hap_ibd['hap2'].to_numpy()
+    swap = ind2 < ind1
+    return { 'ind1' : np.where(swap, ind2, ind1), 'ind2' : np.where(swap, ind1, ind2),
+             'hap1' : np.where(swap, hap2, hap1), 'hap2' : np.where(swap, hap1, hap2),
+             'chrom' : chrom.to_numpy(dtype=np.int16), 'start_bp' : hap_ibd['start_bp'].to_numpy(),
+             'end_bp' : hap_ibd['end_bp'].to_numpy(), 'length' : hap_ibd['length'].to_numpy() }
+
+
+def sweepHapIBDChromosome(pair_rank, hap1, hap2, start_bp, end_bp, start_cM, end_cM):
+    # derive the IBD1/IBD2 segments of every pair from its haplotype IBD segments on one chromosome
+    # returns the runs ordered by pair rank, then position: pair rank, IBD type (0/1), startCM, endCM
+    order = np.lexsort((start_bp, pair_rank))
+    group_starts = np.flatnonzero(np.diff(pair_rank[order], prepend=-1))
+    group_ends = np.append(group_starts[1:], len(order))
+
+    run_cols = [[] for _ in range(4)]
+    for group_start, group_end in zip(group_starts, group_ends):
+        rows = order[group_start:group_end]
+        rank = pair_rank[rows[0]]
+        for run_start_bp, run_end_bp, run_start_cM, run_end_cM, isIBD2 in ibd.sweepIBDSegs(
+                hap1[rows].tolist(), hap2[rows].tolist(), start_bp[rows].tolist(), end_bp[rows].tolist(),
+                start_cM[rows].tolist(), end_cM[rows].tolist()):
+            for col, val in zip(run_cols, (rank, 1 if isIBD2 else 0, run_start_cM, run_end_cM)):
+                col.append(val)
+    return (np.array(run_cols[0], dtype=np.int64), np.array(run_cols[1], dtype=np.int8),
+            np.array(run_cols[2], dtype=np.float64), np.array(run_cols[3], dtype=np.float64))
+
+
+def mapInOrder(executor, func, arg_iter, max_pending):
+    # like executor.map, but only keeps max_pending tasks in flight so a generator of
+    # large arguments (e.g. file blocks) is not read ahead all at once; without an executor, plain map
+    if executor is None:
+        yield from (func(*args) for args in arg_iter)
+        return
+    pending = deque()
+    for args in arg_iter:
+        pending.append(executor.submit(func, *args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def parseHapIBD(file_for_hapibd, snp_map, inds_file, threads=1):
+    # parse a gzipped hapIBD file into arrays:
+    # raw_*: pair, chromosome, length and censoring of every haplotype IBD segment
+    # seg_*: IBD1/IBD2 segments of every pair (a SegmentStore)
+    # pair_*: total IBD1/IBD2 length (cM) of every pair, in order of first appearance
+    # inds: individuals seen (only used without an -u list)
+    # with threads > 1, blocks of the file are parsed and chromosomes are swept in a process pool;
+    # the file is still decompressed by this process, and results are identical to threads = 1
+    executor = futures.ProcessPoolExecutor(threads) if threads > 1 else None
+    try:
+        start = time.time()
+        filter_inds = inds if inds_file != "" else None
+        blocks = list(mapInOrder(executor, parseHapIBDBlock,
+                                 ((block, filter_inds, chrom_name_to_idx) for block in readHapIBDBlocks(file_for_hapibd)),
+                                 2 * threads))
+        if blocks:
+            raw = { col : np.concatenate([block[col] for block in blocks]) for col in blocks[0] }
+        else: #empty hapIBD file
+            raw = { 'ind1' : np.empty(0, dtype=object), 'ind2' : np.empty(0, dtype=object),
+                    'hap1' : np.empty(0, dtype=np.int8), 'hap2' : np.empty(0, dtype=np.int8),
+                    'chrom' : np.empty(0, dtype=np.int16), 'start_bp' : np.empty(0, dtype=np.int64),
+                    'end_bp' : np.empty(0, dtype=np.int64), 'length' : np.empty(0, dtype=np.float64) }
+        del blocks
+        print(f'finished reading hapibd file, takes {time.time()-start}', flush=True)
+
+        ids1, ids2, chrom, start_bp, end_bp = raw['ind1'], raw['ind2'], raw['chrom'], raw['start_bp'], raw['end_bp']
+        censored = (start_bp == np.asarray(chrom_starts_bp)[chrom]) | (end_bp == np.asarray(chrom_ends_bp)[chrom])
+        start_cM = snp_map.toCMByIndex(chrom, start_bp)
+        end_cM = snp_map.toCMByIndex(chrom, end_bp)
+
+        codes, names = pd.factorize(np.concatenate([ids1, ids2]))
+        num_raw = len(ids1)
+        pair_code = codes[:num_raw].astype(np.int64) * len(names) + codes[num_raw:]
+        # pairs are reported in order of first appearance in the hapibd file
+        _, first_seen, pair_idx = np.unique(pair_code, return_index=True, return_inverse=True)
+        pair_rank = np.argsort(np.argsort(first_seen, kind='stable'))[pair_idx]
+        pair_first_row = np.sort(first_seen)
+
+        # chromosomes are independent: sweep each one separately, then merge the runs in chromosome order
+        chr_rows = [(chr, np.flatnonzero(chrom == chr)) for chr in range(num_chrs)]
+        chr_rows = [(chr, rows) for chr, rows in chr_rows if len(rows)]
+        runs = list(mapInOrder(executor, sweepHapIBDChromosome,
+                               ((pair_rank[rows], raw['hap1'][rows], raw['hap2'][rows], start_bp[rows], end_bp[rows],
+                                 start_cM[rows], end_cM[rows]) for chr, rows in chr_rows),
+                               2 * threads))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    # the leading empty arrays fix the dtypes, and keep the concatenation valid when there are no runs
+    run_chrom = np.concatenate([np.empty(0, dtype=np.int16)] +
+                               [np.full(len(run[0]), chr, dtype=np.int16) for (chr, _), run in zip(chr_rows, runs)])
+    run_rank, run_type, run_start_cM, run_end_cM = (np.concatenate([np.empty(0, dtype=dtype)] + [run[col] for run in runs])
+                                                    for col, dtype in enumerate((np.int64, np.int8, np.float64, np.float64)))
+
+    # summed run by run in chromosome order, as a sequential per-pair sum would
+    ibd_len = np.zeros((len(pair_first_row), 2)) #IBD1 and IBD2 length of each pair, in order of first appearance
+    np.add.at(ibd_len, (run_rank, run_type), run_end_cM - run_start_cM)
+
+    pair_ind1, pair_ind2 = ids1[pair_first_row], ids2[pair_first_row]
+    hapibd_cols = buildSegmentStore(pair_ind1[run_rank], pair_ind2[run_rank], run_chrom, run_type,
+                                    run_start_cM, run_end_cM, num_chrs).toArrays(prefix='seg_')
+    hapibd_cols.update({ 'raw_ind1' : ids1.astype(str), 'raw_ind2' : ids2.astype(str), 'raw_chrom' : chrom,
+                         'raw_length' : raw['length'], 'raw_censored' : censored,
+                         'pair_ind1' : pair_ind1.astype(str), 'pair_ind2' : pair_ind2.astype(str),
+                         'pair_ibd1' : ibd_len[:, 0], 'pair_ibd2' : ibd_len[:, 1],
+                         'inds' : np.array(pd.unique(np.column_stack((ids1, ids2)).ravel()), dtype=str) })
+    return hapibd_cols
 #MY MODIFICATION ENDS
 
 
-def readSegments(file_for_segments):
-    all_segs = {}
-    df_ibd = pd.read_csv(file_for_segments, sep=r"\s+")
-    for index, row in df_ibd.iterrows():
-        if row['iid1'] < row['iid2']:
-            ids = [ row['iid1'], row['iid2'] ]
-        else:
-            ids = [ row['iid2'], row['iid1'] ]
-
-        if not ids[0] in all_segs:
-            all_segs[ ids[0] ] = \
-                    { ids[1]: [ { chr : [] for chr in range(num_chrs) } for _ in range(2) ] }
-        elif not ids[1] in all_segs[ ids[0] ]:
-            all_segs[ ids[0] ][ ids[1] ] = \
-                                [ { chr : [] for chr in range(num_chrs) } for _ in range(2) ]
-        chrom_name = str(row['ch'])
-        chr = chrom_name_to_idx[chrom_name]
-        ibd_type = int(row['ibd_type'][-1])
-        all_segs[ ids[0] ][ ids[1] ][ibd_type - 1][chr].append([float(row['startCM']), float(row['endCM'])])
-
-    return all_segs
+READ_CHUNK_ROWS = 1 << 20 #rows of a text table parsed at a time by readSampleRows
+
+
+def readSampleRows(file, id_cols, keep_ids, **read_csv_args):
+    # read a table with pandas, chunk by chunk, keeping only the rows whose id_cols are all in keep_ids
+    # (all rows if keep_ids is None), so memory is proportional to the rows kept
+    chunks = []
+    for chunk in pd.read_csv(file, chunksize=READ_CHUNK_ROWS, **read_csv_args):
+        if keep_ids is not None:
+            chunk = chunk[np.logical_and.reduce([chunk[col].isin(keep_ids).values for col in id_cols])]
+        chunks.append(chunk)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def readSegments(file_for_segments, mapfile, samples, cache_dir='', max_lazy_pairs=0, keep_pairs=None):
+    # parse the .seg file once into typed columns, grouped by pair (see DRUID_segments.SegmentStore)
+    # only segments between samples, and if given of pairs whose key is in keep_pairs, are kept
+    # chromosome indices come from the map, so a cached copy is only valid for the same map
+    # with max_lazy_pairs, only index the file and read the segments of a pair when they are first
+    # needed, keeping at most max_lazy_pairs pairs in memory (see DRUID_segments.LazySegmentStore)
+    params = { 'samples' : arraysFingerprint(np.array(samples.names, dtype=str)),
+               'pairs' : arraysFingerprint(keep_pairs) if keep_pairs is not None else None }
+    if max_lazy_pairs:
+        segindex_cols = loadCachedArrays(cache_dir, 'segindex', [file_for_segments], params,
+                                         lambda: buildLazySegmentStore(file_for_segments, chrom_name_to_idx, num_chrs, max_lazy_pairs,
+                                                                       samples, keep_pairs).toArrays())
+        return lazySegmentStoreFromArrays(segindex_cols, file_for_segments, chrom_name_to_idx, num_chrs, max_lazy_pairs)
+
+    def parseSegments():
+        df_ibd = readSampleRows(file_for_segments, ['iid1', 'iid2'], samples.index, sep=r"\s+",
+                                usecols=['iid1', 'iid2', 'ch', 'ibd_type', 'startCM', 'endCM'],
+                                dtype={'iid1': str, 'iid2': str, 'ch': str, 'ibd_type': str, 'startCM': np.float64, 'endCM': np.float64},
+                                float_precision='round_trip')
+        if keep_pairs is not None:
+            keys = packPairKeys(samples.codes(df_ibd['iid1']), samples.codes(df_ibd['iid2']))
+            df_ibd = df_ibd[np.isin(keys, keep_pairs)]
+        chrom = df_ibd['ch'].map(chrom_name_to_idx)
+        if chrom.isna().any():
+            raise KeyError(df_ibd['ch'][chrom.isna()].iloc[0])
+        ibd_type = df_ibd['ibd_type'].str[-1].astype(np.int8) - 1 # chop "IBD" off, get integer type IBD_1_ or 2
+
+        return buildSegmentStore(df_ibd['iid1'].values, df_ibd['iid2'].values, chrom.values, ibd_type.values,
+                                 df_ibd['startCM'].values, df_ibd['endCM'].values, num_chrs, samples).toArrays()
+
+    return segmentStoreFromArrays(loadCachedArrays(cache_dir, 'seg', [file_for_segments, mapfile], params, parseSegments), num_chrs)
 
 # def readSegments(file_for_segments):
 #     all_segs = {}
@@ -368,7 +510,7 @@ def inferSecondPath(rel_graph, rel_graph_tmp, all_rel, second, all_segs, outfile
                         if not rel_graph_tmp.has_edge(av,sib):
                             addEdgeType(av,sib,'AU','NN',rel_graph) # if the provided family information doesn't contain this relationship, add it
                         else:
-                            print(av+" inferred as aunt/uncle of "+sib+", but will continue using provided relationship type "+rel_graph_tmp[av][sib]['type']+'\n')
+                            print(samples.name(av)+" inferred as aunt/uncle of "+samples.name(sib)+", but will continue using provided relationship type "+rel_graph_tmp[av][sib]['type']+'\n')
 
 
                 if len(avunc_hs_all):
@@ -378,7 +520,7 @@ def inferSecondPath(rel_graph, rel_graph_tmp, all_rel, second, all_segs, outfile
                                 if not rel_graph_tmp.has_edge(av, sib):
                                     addEdgeType(av, sib, 'AU', 'NN', rel_graph)  # if the provided family information doesn't contain this relationship, add it
                                 else:
-                                    print(av + " inferred as aunt/uncle of " + sib + ", but will continue using provided relationship type " + rel_graph_tmp[av][sib]['type'] + '\n')
+                                    print(samples.name(av) + " inferred as aunt/uncle of " + samples.name(sib) + ", but will continue using provided relationship type " + rel_graph_tmp[av][sib]['type'] + '\n')
 
             checked = checked.union(sibs)
 
@@ -391,83 +533,74 @@ def inferSecondPath(rel_graph, rel_graph_tmp, all_rel, second, all_segs, outfile
             checked = checked.union(siblings)
 
 
-def getFamInfo(famfile, inds):
-    #read in faminfo file
+def getFamInfo(famfile, samples):
+    #read in faminfo file, keyed by sample code
     global faminfo
     faminfo = {}
     file = open(famfile,'r')
     for line in file:
         l = str.split(line.rstrip())
         if l != []:
-            if l[0] in inds and l[1] in inds:
-                if not l[0] in faminfo.keys():
-                    faminfo[l[0]] = {}
-                if not l[1] in faminfo.keys():
-                    faminfo[l[1]] = {}
-                faminfo[l[0]][l[1]] = l[2]
+            if l[0] in samples and l[1] in samples:
+                i0, i1 = samples.code(l[0]), samples.code(l[1])
+                if not i0 in faminfo.keys():
+                    faminfo[i0] = {}
+                if not i1 in faminfo.keys():
+                    faminfo[i1] = {}
+                faminfo[i0][i1] = l[2]
                 if l[2] == 'FS' or l[2] == 'HS':
-                    faminfo[l[1]][l[0]] = l[2]
+                    faminfo[i1][i0] = l[2]
                 elif l[2] == 'P':
-                    faminfo[l[1]][l[0]] = 'C'
+                    faminfo[i1][i0] = 'C'
                 elif l[2] == 'C':
-                    faminfo[l[1]][l[0]] = 'P'
+                    faminfo[i1][i0] = 'P'
                 elif l[2] == 'AU':
-                    faminfo[l[1]][l[0]] = 'NN'
+                    faminfo[i1][i0] = 'NN'
                 elif l[2] == 'NN':
-                    faminfo[l[1]][l[0]] = 'AU'
+                    faminfo[i1][i0] = 'AU'
                 elif l[2] == 'GC':
-                    faminfo[l[1]][l[0]] = 'GP'
+                    faminfo[i1][i0] = 'GP'
                 elif l[2] == 'GP':
-                    faminfo[l[1]][l[0]] = 'GC'
+                    faminfo[i1][i0] = 'GC'
                 else:
                     file.close()
                     raise ValueError(str(l[2]) + ' is not an accepted relationship type (FS, P, C, AU, NN, GC, GP, HS)')
             else:
-                if not l[0] in inds:
+                if not l[0] in samples:
                     print("Warning: "+l[0]+" not included in .inds file, not including "+l[2]+" relationship with "+l[1])
-                if not l[1] in inds:
+                if not l[1] in samples:
                     print("Warning: "+l[1]+" not included in .inds file, not including "+l[2]+" relationship with "+l[0])
 
     file.close()
 
     return faminfo
 
-def getChrInfo(mapfile):
+def getChrInfo(mapfile, cache_dir=''):
     #read in information from .map file
     global total_genome, chrom_name_to_idx, chrom_idx_to_name, chrom_starts, chrom_ends, num_chrs, chrom_starts_bp, chrom_ends_bp
-    chrom_name_to_idx = {}
-    chrom_idx_to_name = []
+    def parseMap():
+        df_map = pd.read_csv(mapfile, sep=r'\s+', header=None, usecols=[0, 2, 3], dtype={0: str, 2: np.float64, 3: np.int64},
+                             float_precision='round_trip')
+        return { 'chr_names' : df_map[0].to_numpy(dtype=str), 'pos' : df_map[2].values, 'bp' : df_map[3].values }
+    map_cols = loadCachedArrays(cache_dir, 'map', [mapfile], {}, parseMap)
+    chr_names, pos, bp = map_cols['chr_names'], map_cols['pos'], map_cols['bp']
+    snp_map = buildGeneticMap(chr_names, bp, pos)
+    chrom_idx_to_name = snp_map.chrom_idx_to_name
+    chrom_name_to_idx = snp_map.chrom_name_to_idx
+    num_chrs = len(chrom_idx_to_name)
+
+    # first and last marker (in cM) of each chromosome
     chrom_starts = []
     chrom_ends = []
     chrom_starts_bp = []
     chrom_ends_bp = []
-    num_chrs = 0
-    snp_map = defaultdict(lambda : {})
-
-    with open(mapfile, 'r') as file:
-        for line in file:
-            chr_name, _, pos, bp, *_ = line.strip().split()
-            pos, bp = float(pos), int(bp)
-            if not chr_name in chrom_name_to_idx.keys():
-                chrom_name_to_idx[chr_name] = chr = num_chrs
-                chrom_idx_to_name.append(chr_name)
-                num_chrs += 1
-                chrom_starts.append(99999999)
-                chrom_ends.append(0)
-                chrom_starts_bp.append(99999999)
-                chrom_ends_bp.append(0)
-            else:
-                chr = chrom_name_to_idx[chr_name]
-
-            snp_map[chr_name][bp] = pos
-
-            if chrom_starts[chr] > pos:
-                chrom_starts[chr] = pos
-                chrom_starts_bp[chr] = bp
-            if chrom_ends[chr] < pos:
-                chrom_ends[chr] = pos
-                chrom_ends_bp[chr] = bp
-
+    for chr_name in chrom_idx_to_name:
+        rows = np.flatnonzero(chr_names == chr_name)
+        first, last = rows[np.argmin(pos[rows])], rows[np.argmax(pos[rows])]
+        chrom_starts.append(float(pos[first]))
+        chrom_ends.append(float(pos[last]))
+        chrom_starts_bp.append(int(bp[first]))
+        chrom_ends_bp.append(int(bp[last]))
 
     total_genome = 0
     for chr in range(num_chrs):
@@ -479,11 +612,10 @@ def getChrInfo(mapfile):
         for chr in range(num_chrs):
             chrom_starts[chr] *= 100
             chrom_ends[chr] *= 100
-        for chr_name in snp_map.keys():
-            for bp in snp_map[chr_name].keys():
-                snp_map[chr_name][bp] *= 100
+            snp_map.cM[chr] = snp_map.cM[chr] * 100
 
-    return [total_genome, chrom_name_to_idx, chrom_idx_to_name, chrom_starts, chrom_ends, num_chrs, snp_map]
+    genome = buildGenomeContext(snp_map, chrom_starts, chrom_ends, total_genome)
+    return [total_genome, chrom_name_to_idx, chrom_idx_to_name, chrom_starts, chrom_ends, num_chrs, snp_map, genome]
 
 
 def getInferredFromK(K):
@@ -516,16 +648,18 @@ def getInferredFromK(K):
         return -1
 
 
+# getInferredFromK thresholds, loosest first, and the degree of K falling at or above each of them
+K_thresholds = np.array([degrees[d] for d in range(11, 0, -1)] + [degrees['MZ']])
+K_threshold_degrees = np.array([-1] + list(range(11, 0, -1)) + [0])
+
+def getInferredFromKArray(K):
+    # vectorized getInferredFromK: count the thresholds each K reaches and look up the degree
+    return K_threshold_degrees[np.searchsorted(K_thresholds, K, side='right')]
+
+
 def getIBDsegments(ind1, ind2, all_segs):
     # get IBD segments between ind1 and ind2, sorting segments by IBD2, IBD1, and IBD0
-    if ind1 < ind2:
-        ids = [ ind1, ind2 ]
-    else:
-        ids = [ ind2, ind1 ]
-    if not ids[0] in all_segs.keys() or not ids[1] in all_segs[ ids[0] ].keys():
-        return [ { chr : [] for chr in range(num_chrs) } for _ in range(2) ]
-
-    return all_segs[ ids[0] ][ ids[1] ]
+    return all_segs.getSegments(ind1, ind2)
 
 
 def getIBD0(IBD1,IBD2):
@@ -571,6 +705,62 @@ def mergeIntervals(intervals):
     return merged
 
 
+class StateTrackCache(object):
+    # IBD state tracks of the pairs of one segment store: (IBD0, IBD1, IBD2), each a tuple by chromosome of sorted
+    # (start, end) tuples; a track is built the first time its pair is needed (IBD0 the first time it is asked for)
+    # and never modified, so all callers share it. Least recently used tracks are dropped first once their
+    # estimated size exceeds max_bytes
+    def __init__(self, all_segs, max_bytes=STATE_TRACK_CACHE_BYTES):
+        self.all_segs = all_segs
+        self.max_bytes = max_bytes
+        self.tracks = OrderedDict() #pair key -> [IBD0 or None, IBD1, IBD2, estimated bytes]
+        self.bytes = 0
+
+    def get(self, ind1, ind2, ibd0=True):
+        # track of ind1 and ind2; without ibd0, its IBD0 may be None
+        key = getPairKey(ind1, ind2)
+        entry = self.tracks.get(key)
+        if entry is None:
+            IBD1, IBD2 = getIBDsegments(ind1, ind2, self.all_segs)
+            entry = self.tracks[key] = [None, sortedTrack(IBD1), sortedTrack(IBD2), 0]
+            self.resize(entry, STATE_TRACK_BYTES + trackBytes(entry[1]) + trackBytes(entry[2]))
+        else:
+            self.tracks.move_to_end(key)
+        if ibd0 and entry[0] is None:
+            entry[0] = sortedTrack(getIBD0(entry[1], entry[2]))
+            self.resize(entry, entry[3] + trackBytes(entry[0]))
+        return entry[0], entry[1], entry[2]
+
+    def resize(self, entry, size):
+        # set the estimated size of entry and drop the least recently used tracks (but not the last one) while over max_bytes
+        self.bytes += size - entry[3]
+        entry[3] = size
+        while self.bytes > self.max_bytes and len(self.tracks) > 1:
+            self.bytes -= self.tracks.popitem(last=False)[1][3]
+
+
+def sortedTrack(IBD):
+    # IBD regions as a tuple by chromosome of sorted (start, end) tuples
+    return tuple(tuple(tuple(seg) for seg in sorted(IBD[chr])) for chr in range(num_chrs))
+
+
+def trackBytes(IBD):
+    # approximate memory of a tuple made by sortedTrack
+    return CHROMOSOME_TRACK_BYTES * len(IBD) + INTERVAL_BYTES * sum(len(segs) for segs in IBD)
+
+
+state_track_caches = weakref.WeakKeyDictionary() #segment store -> its StateTrackCache
+
+
+def getStateTrack(ind1, ind2, all_segs, ibd0=True):
+    # IBD state track (IBD0, IBD1, IBD2 regions by chromosome, sorted) of ind1 and ind2, IBD0 possibly None without
+    # ibd0; shared, must not be modified
+    cache = state_track_caches.get(all_segs)
+    if cache is None:
+        cache = state_track_caches[all_segs] = StateTrackCache(all_segs)
+    return cache.get(ind1, ind2, ibd0)
+
+
 def collectIBDsegments(sibset, all_segs):
     # collect pairwise IBD0,1,2 regions between all pairs of siblings
     IBD_all = {}
@@ -578,16 +768,7 @@ def collectIBDsegments(sibset, all_segs):
         if not ind1 in IBD_all.keys():
             IBD_all[ind1] = {}
 
-        IBD_all[ind1][ind2] = None
-
-        tmp = getIBDsegments(ind1, ind2, all_segs)
-        tmp0 = getIBD0(tmp[0],tmp[1])
-        for chr in range(num_chrs):
-            tmp0[chr].sort()
-            tmp[0][chr].sort()
-            tmp[1][chr].sort()
-
-        IBD_all[ind1][ind2] = [tmp0, tmp[0], tmp[1]]
+        IBD_all[ind1][ind2] = getStateTrack(ind1, ind2, all_segs)
 
     return IBD_all
 
@@ -623,17 +804,7 @@ def collectIBDsegmentsSibsAvuncular(sibset, avunc, all_segs):  # n is number of
         if not ind1 in IBD_all.keys():
             IBD_all[ind1] = {}
         for ind2 in avunc:
-            if not ind2 in IBD_all[ind1].keys():
-                IBD_all[ind1][ind2] = None
-
-            tmp = getIBDsegments(ind1, ind2, all_segs)
-            #tmp0 = getIBD0(tmp[0],tmp[1])
-            for chr in range(num_chrs):
-                #tmp0[chr].sort()
-                tmp[0][chr].sort()
-                tmp[1][chr].sort()
-
-            IBD_all[ind1][ind2] = [[],tmp[0],tmp[1]]
+            IBD_all[ind1][ind2] = getStateTrack(ind1, ind2, all_segs, ibd0=False)
 
     return IBD_all
 
@@ -648,7 +819,7 @@ def collectIBDsegmentsSibsAvuncularCombine(sibset, avunc, all_segs):
         IBD_all[ind1]['A'] = []
         tmp_ind1 = [ { chr : [] for chr in range(num_chrs) } for _ in range(2) ]
         for ind2 in avunc:
-            tmp = getIBDsegments(ind1, ind2, all_segs) #[IBD1, IBD2]
+            tmp = getStateTrack(ind1, ind2, all_segs, ibd0=False)[1:] #[IBD1, IBD2]
             # for chr in range(num_chrs):
             #     tmp[0][chr].sort()
             # for chr in range(num_chrs):
@@ -676,6 +847,64 @@ def checkOverlap(range1, range2):
 
 
 
+def tripleOverlaps(segs, avsegs1, avsegs2):
+    # sweep three sorted lists of segments, yielding [start, end] of each region where one segment of every list overlap
+    ksib = 0
+    kav1 = 0
+    kav2 = 0
+    while ksib < len(segs) and kav1 < len(avsegs1) and kav2 < len(avsegs2):
+        seg, av1, av2 = segs[ksib], avsegs1[kav1], avsegs2[kav2]
+        if checkOverlap(seg, av1) and checkOverlap(seg, av2) and checkOverlap(av2, av1):
+            yield [max(seg[0], av1[0], av2[0]), min(seg[1], av1[1], av2[1])]
+        # move past the segment that ends first
+        if seg[1] <= av1[1] and seg[1] <= av2[1]:
+            ksib = ksib + 1
+        elif av1[1] <= seg[1] and av1[1] <= av2[1]:
+            kav1 = kav1 + 1
+        elif av2[1] <= seg[1] and av2[1] <= av1[1]:
+            kav2 = kav2 + 1
+
+
+def unclaimedRanges(range_add, ranges, ends, chr):
+    # parts of range_add = [start, end, Eval, sib1, sib2, av] in the gaps between the sorted ranges of chromosome chr,
+    # with ends their end positions; a zero-length range_add before the first range is kept as is
+    start, end, Eval, sib1, sib2, av = range_add
+    range_new = []
+    krange = bisect.bisect_right(ends, start)
+    while krange < len(ranges):
+        claimed = ranges[krange]
+        if range_add[0:2] != claimed[0:2]:
+            if checkOverlap(range_add, claimed):
+                if start < claimed[0]:  # new range starts before ranges[krange]
+                    if krange > 0:
+                        range_new.append([max(start, ranges[krange - 1][1]), claimed[0], Eval, sib1, sib2, av])
+                    else:
+                        range_new.append([start, claimed[0], Eval, sib1, sib2, av])
+                if end > claimed[1]:  # new range ends after krange
+                    if krange < len(ranges) - 1:
+                        new_range = [claimed[1], min(end, ranges[krange + 1][0]), Eval, sib1, sib2, av]
+                        range_new.append(new_range)
+                        if new_range[0] > new_range[1]:
+                            chr_name = chrom_idx_to_name[chr]
+                            print('ERROR: '+samples.name(sib1)+'\t'+samples.name(sib2)+'\t'+samples.name(av)+'\t'+ chr_name + '\t' + str(claimed[1]) + '\t' + str(
+                                ranges[krange + 1][0]) + '\n')
+                    else:
+                        range_new.append([claimed[1], end, Eval, sib1, sib2, av])
+            elif krange > 0:  # no overlap between range_add and ranges[krange]
+                range_new.append([max(ranges[krange - 1][1], start), end, Eval, sib1, sib2, av])
+            else:
+                return [range_add]
+        if claimed[1] >= end:
+            return [seg for seg in range_new if seg[0] != seg[1]]
+        krange = krange + 1 # range_add continues past ranges[krange]
+
+    if krange > 0:
+        range_new.append([max(ranges[krange - 1][1], start), end, Eval, sib1, sib2, av])
+    else:
+        range_new.append(range_add)
+    return [seg for seg in range_new if seg[0] != seg[1]]
+
+
 def findOverlap(sibseg, avsib, ss1, sa1, sa2, Eval):
     # Find regions of the genome which have sibling and avuncular IBD states as defined by ss1, sa1, sa2
     # ranges = ranges we already have in place and therefore cannot overlap; we update and return ranges with added info
@@ -694,147 +923,36 @@ def findOverlap(sibseg, avsib, ss1, sa1, sa2, Eval):
     # sibseg = collectIBDsegments(sib1, all_segs)
     # avsib = collectIBDsegmentsSibsAvuncularCombine(sib1, sib2, all_segs)
     # IBD011 = findOverlap(sibseg, avsib, 0, 1, 1, 0.5)
-    all_seg = { chr : [] for chr in range(num_chrs) }
+    # each (sib1, sib2, av) combination in turn claims the parts of its three-way overlaps not claimed before it:
+    # ranges[chr] holds the claimed parts, sorted, and ends their end positions, to find by bisection the first
+    # claimed range that ends after an overlap starts
     ranges = { chr : [] for chr in range(num_chrs) }
     for chr in range(num_chrs):
+        chr_ranges = ranges[chr]
+        ends = []
         for sib1 in sibseg.keys():
             for sib2 in sibseg[sib1].keys():
                 for av in avsib[sib1].keys():  # avsib[sib1].keys() and avsib[sib2].keys() are the same
                     ranges_to_append = []
-                    ksib = 0
-                    kav1 = 0
-                    kav2 = 0
-                    krange_cont = 0
-                    while ksib < len(sibseg[sib1][sib2][ss1][chr]) and kav1 < len(avsib[sib1][av][sa1][chr]) and kav2 < len(avsib[sib2][av][sa2][chr]):
-
-                        if checkOverlap(sibseg[sib1][sib2][ss1][chr][ksib],
-                                        avsib[sib1][av][sa1][chr][kav1]) and checkOverlap(
-                                sibseg[sib1][sib2][ss1][chr][ksib], avsib[sib2][av][sa2][chr][kav2]) and checkOverlap(
-                                avsib[sib2][av][sa2][chr][kav2], avsib[sib1][av][sa1][chr][kav1]):
-                            # if all three segments overlap
-                            range_add = [max(sibseg[sib1][sib2][ss1][chr][ksib][0], avsib[sib1][av][sa1][chr][kav1][0],
-                                             avsib[sib2][av][sa2][chr][kav2][0]),
-                                         min(sibseg[sib1][sib2][ss1][chr][ksib][1], avsib[sib1][av][sa1][chr][kav1][1],
-                                             avsib[sib2][av][sa2][chr][kav2][1]), Eval, sib1, sib2, av]
-                            to_append = [range_add[0],range_add[1],sib1,sib2,av]
-                            all_seg[chr].append(to_append)
-                            if not krange_cont:
-                                krange = 0
-                                while krange < len(ranges[chr]) and ranges[chr][krange][1] <= range_add[0]:
-                                    krange = krange + 1
-
-                            if krange < len(ranges[chr]):
-                                if range_add[0:2] != ranges[chr][krange][0:2]:
-                                    if checkOverlap(range_add, ranges[chr][krange]):
-                                        range_new = []
-                                        if range_add[0] < ranges[chr][krange][0]:  # new range starts before ranges[krange]
-                                            if krange > 0:
-                                                range_new.append([max(range_add[0], ranges[chr][krange - 1][1]),
-                                                                  ranges[chr][krange][0], Eval, sib1, sib2, av])
-                                            else:
-                                                range_new.append(
-                                                    [range_add[0], ranges[chr][krange][0], Eval, sib1, sib2, av])
-                                        if range_add[1] > ranges[chr][krange][1]:  # new range ends after krange
-                                            if krange < len(ranges[chr]) - 1:
-                                                new_range = [ranges[chr][krange][1],
-                                                             min(range_add[1], ranges[chr][krange + 1][0]), Eval, sib1,
-                                                             sib2, av]
-                                                if new_range[0] != new_range[1]:
-                                                    range_new.append(new_range)
-                                                if new_range[0] > new_range[1]:
-                                                    chr_name = chrom_idx_to_name[chr]
-                                                    print('ERROR: '+sib1+'\t'+sib2+'\t'+av+'\t'+ chr_name + '\t' + str(ranges[chr][krange][1]) + '\t' + str(
-                                                        ranges[chr][krange + 1][0]) + '\n')
-                                            else:
-                                                range_new.append(
-                                                    [ranges[chr][krange][1], range_add[1], Eval, sib1, sib2, av])
-                                        # krange = krange + 1
-                                        for seg in range_new:
-                                            if not seg in ranges_to_append and not seg[0] == seg[1]:
-                                                ranges_to_append.append(seg)
-                                    else:  # no overlap between range_add and ranges[chr][krange]
-                                        if krange > 0:
-                                            range_add = [max(ranges[chr][krange - 1][1], range_add[0]), range_add[1],
-                                                         Eval, sib1, sib2, av]
-                                            if not range_add in ranges_to_append and not range_add[0] == range_add[1]:
-                                                ranges_to_append.append(range_add)
-                                        else:
-                                            if not range_add in ranges_to_append:
-                                                ranges_to_append.append(range_add)
-                            else:
-                                if krange > 0:
-                                    range_add = [max(ranges[chr][krange - 1][1], range_add[0]), range_add[1], Eval,
-                                                 sib1, sib2, av]
-                                    if not range_add in ranges_to_append and not range_add[0] == range_add[1]:
-                                        ranges_to_append.append(range_add)
-                                else:
-                                    if not range_add in ranges_to_append and not range_add[0] == range_add[1]:
-                                        ranges_to_append.append(range_add)
-                            if krange < len(ranges[chr]):
-
-                                if sibseg[sib1][sib2][ss1][chr][ksib][1] <= avsib[sib1][av][sa1][chr][kav1][1] and \
-                                                sibseg[sib1][sib2][ss1][chr][ksib][1] <= \
-                                                avsib[sib2][av][sa2][chr][kav2][1] and \
-                                                sibseg[sib1][sib2][ss1][chr][ksib][1] <= ranges[chr][krange][1]:
-                                    ksib = ksib + 1
-                                    krange_cont = 0
-
-                                elif avsib[sib1][av][sa1][chr][kav1][1] <= sibseg[sib1][sib2][ss1][chr][ksib][1] and \
-                                                avsib[sib1][av][sa1][chr][kav1][1] <= avsib[sib2][av][sa2][chr][kav2][
-                                            1] and avsib[sib1][av][sa1][chr][kav1][1] <= ranges[chr][krange][1]:
-                                    kav1 = kav1 + 1
-                                    krange_cont = 0
-
-                                elif avsib[sib2][av][sa2][chr][kav2][1] <= sibseg[sib1][sib2][ss1][chr][ksib][1] and \
-                                                avsib[sib2][av][sa2][chr][kav2][1] <= avsib[sib1][av][sa1][chr][kav1][
-                                            1] and avsib[sib2][av][sa2][chr][kav2][1] <= ranges[chr][krange][1]:
-                                    kav2 = kav2 + 1
-                                    krange_cont = 0
-
-                                elif ranges[chr][krange][1] <= sibseg[sib1][sib2][ss1][chr][ksib][1] and \
-                                                ranges[chr][krange][1] <= avsib[sib1][av][sa1][chr][kav1][1] and \
-                                                ranges[chr][krange][1] <= avsib[sib2][av][sa2][chr][kav2][1]:
-                                    krange = krange + 1
-                                    krange_cont = 1
-
-                            else:
-                                if sibseg[sib1][sib2][ss1][chr][ksib][1] <= avsib[sib1][av][sa1][chr][kav1][1] and \
-                                                sibseg[sib1][sib2][ss1][chr][ksib][1] <= \
-                                                avsib[sib2][av][sa2][chr][kav2][1]:
-                                    ksib = ksib + 1
-                                    krange_cont = 0
-                                elif avsib[sib1][av][sa1][chr][kav1][1] <= sibseg[sib1][sib2][ss1][chr][ksib][1] and \
-                                                avsib[sib1][av][sa1][chr][kav1][1] <= avsib[sib2][av][sa2][chr][kav2][
-                                            1]:
-                                    kav1 = kav1 + 1
-                                    krange_cont = 0
-                                elif avsib[sib2][av][sa2][chr][kav2][1] <= sibseg[sib1][sib2][ss1][chr][ksib][1] and \
-                                                avsib[sib2][av][sa2][chr][kav2][1] <= avsib[sib1][av][sa1][chr][kav1][
-                                            1]:
-                                    kav2 = kav2 + 1
-                                    krange_cont = 0
-
-                        elif sibseg[sib1][sib2][ss1][chr][ksib][1] <= avsib[sib1][av][sa1][chr][kav1][1] and \
-                                        sibseg[sib1][sib2][ss1][chr][ksib][1] <= avsib[sib2][av][sa2][chr][kav2][1]:
-                            ksib = ksib + 1
-                            krange_cont = 0
-                        elif avsib[sib1][av][sa1][chr][kav1][1] <= sibseg[sib1][sib2][ss1][chr][ksib][1] and \
-                                        avsib[sib1][av][sa1][chr][kav1][1] <= avsib[sib2][av][sa2][chr][kav2][1]:
-                            kav1 = kav1 + 1
-                            krange_cont = 0
-                        elif avsib[sib2][av][sa2][chr][kav2][1] <= sibseg[sib1][sib2][ss1][chr][ksib][1] and \
-                                        avsib[sib2][av][sa2][chr][kav2][1] <= avsib[sib1][av][sa1][chr][kav1][1]:
-                            kav2 = kav2 + 1
-                            krange_cont = 0
-
-                    ranges[chr] += ranges_to_append
-                    ranges[chr].sort()
+                    appended = set()
+                    for range_add in tripleOverlaps(sibseg[sib1][sib2][ss1][chr], avsib[sib1][av][sa1][chr],
+                                                    avsib[sib2][av][sa2][chr]):
+                        range_add += [Eval, sib1, sib2, av]
+                        for seg in unclaimedRanges(range_add, chr_ranges, ends, chr):
+                            if not (seg[0], seg[1]) in appended:
+                                appended.add((seg[0], seg[1]))
+                                ranges_to_append.append(seg)
+
+                    for seg in ranges_to_append:
+                        krange = bisect.bisect_right(chr_ranges, seg)
+                        chr_ranges.insert(krange, seg)
+                        ends.insert(krange, seg[1])
 
     return ranges
 
 
 
-def getSiblingRelativeFamIBDLengthIBD2(sib1, sib2, avunc1, avunc2, all_segs, sorted_snp_pos, accu):
+def getSiblingRelativeFamIBDLengthIBD2(sib1, sib2, avunc1, avunc2, all_segs, genome, accu):
     #get total IBD length between two sets of relatives (sib1+avunc1 and sib2+avunc2)
     #return length and number of individuals in each set with IBD segments
     sibandav = sib1.copy()
@@ -846,8 +964,8 @@ def getSiblingRelativeFamIBDLengthIBD2(sib1, sib2, avunc1, avunc2, all_segs, sor
         sibandav_rel.add(avunc)
 
 
-    all_seg_IBD1 = { chr : [] for chr in range(num_chrs) }
-    all_seg_IBD2 = { chr : [] for chr in range(num_chrs) }
+    all_seg_IBD1 = { chr : [] for chr in range(genome.num_chrs) }
+    all_seg_IBD2 = { chr : [] for chr in range(genome.num_chrs) }
     has_seg_sib1 = [0 for x in range(len(sib1))]
     has_seg_sib2 = [0 for x in range(len(sib2))]
     has_seg_avunc1 = [0 for x in range(len(avunc1))]
@@ -858,8 +976,8 @@ def getSiblingRelativeFamIBDLengthIBD2(sib1, sib2, avunc1, avunc2, all_segs, sor
     avunc2 = list(avunc2)
     for ind1 in sibandav:
         for ind2 in sibandav_rel:
-            tmp = getIBDsegments(ind1, ind2, all_segs)
-            for chr in range(num_chrs):  # add IBD1
+            tmp = getStateTrack(ind1, ind2, all_segs, ibd0=False)[1:] #[IBD1, IBD2]
+            for chr in range(genome.num_chrs):  # add IBD1
                 if len(tmp[0][chr]) > 0 or len(tmp[1][chr]) > 0:
                     # mark if these individuals have segments that were used
                     if ind1 in sib1:
@@ -878,7 +996,7 @@ def getSiblingRelativeFamIBDLengthIBD2(sib1, sib2, avunc1, avunc2, all_segs, sor
                                             sum(has_seg_avunc1), sum(has_seg_avunc2)
 
     IBD_sum = 0
-    for chr in range(num_chrs):
+    for chr in range(genome.num_chrs):
         all_seg_IBD1[chr] = mergeIntervals(all_seg_IBD1[chr][:])
         for seg in all_seg_IBD1[chr]:
             IBD_sum += seg[1] - seg[0]
@@ -894,74 +1012,84 @@ def getSiblingRelativeFamIBDLengthIBD2(sib1, sib2, avunc1, avunc2, all_segs, sor
 
     if accu:
         if sib1_len > 1:
-            prop_sib1 = calcTransmissionPropandMerge_sib(sib1, all_segs, sorted_snp_pos)
+            prop_sib1 = calcTransmissionPropandMerge_sib(sib1, all_segs, genome)
             #print(f'number of sibs: {len(sib1)}, transmitted prop is {prop_sib1}')
         if sib2_len > 1:
-            prop_sib2 = calcTransmissionPropandMerge_sib(sib2, all_segs, sorted_snp_pos)
+            prop_sib2 = calcTransmissionPropandMerge_sib(sib2, all_segs, genome)
             #print(f'number of sibs: {len(sib2)}, transmitted prop is {prop_sib2}')
         if av1_len > 1:
-            prop_av1 = calcTransmissionPropandMerge_sib(avunc1, all_segs, sorted_snp_pos)
+            prop_av1 = calcTransmissionPropandMerge_sib(avunc1, all_segs, genome)
             #print(f'number of sibs: {len(avunc1)}, transmitted prop is {prop_av1}')
         if av2_len > 1:
-            prop_av2 = calcTransmissionPropandMerge_sib(avunc2, all_segs, sorted_snp_pos)
+            prop_av2 = calcTransmissionPropandMerge_sib(avunc2, all_segs, genome)
             #print(f'number of sibs: {len(avunc2)}, transmitted prop is {prop_av2}')
 
     return IBD_sum, prop_sib1, prop_sib2, prop_av1, prop_av2, sib1_len, sib2_len, av1_len, av2_len
 
-def calcTransmissionPropandMerge_sib(sibs, all_segs, sorted_snp_pos):
+def calcTransmissionPropandMerge_sib(sibs, all_segs, genome):
     both_copy = one_copy = 0
-    all_seg_IBD1 = { chr : [] for chr in range(num_chrs) }
-    all_seg_IBD2 = { chr : [] for chr in range(num_chrs) }
+    total_genome = genome.total_genome
+    all_seg_IBD1 = { chr : [] for chr in range(genome.num_chrs) }
+    all_seg_IBD2 = { chr : [] for chr in range(genome.num_chrs) }
     for ind1, ind2 in itertools.combinations(sibs, 2):
-        tmp = getIBDsegments(ind1, ind2, all_segs)
-        for chr in range(num_chrs):
+        tmp = getStateTrack(ind1, ind2, all_segs, ibd0=False)[1:] #[IBD1, IBD2]
+        for chr in range(genome.num_chrs):
             all_seg_IBD1[chr] += tmp[0][chr]
             all_seg_IBD2[chr] += tmp[1][chr]
-    for chr in range(num_chrs):
+    for chr in range(genome.num_chrs):
         one_copy_chr, both_copy_chr = \
-                transmission_sib_per_chr(all_seg_IBD1[chr], all_seg_IBD2[chr], sorted_snp_pos[chr], len(sibs))
+                transmission_sib_per_chr(all_seg_IBD1[chr], all_seg_IBD2[chr], genome.sorted_snp_pos[chr], len(sibs))
         both_copy += both_copy_chr
         one_copy += one_copy_chr
     return both_copy/total_genome + 0.5*one_copy/total_genome + 0.75*(total_genome - both_copy - one_copy)/total_genome
 
 def transmission_sib_per_chr(IBD1segs_chr, IBD2segs_chr, sorted_snp_pos_chr, num_sibs):
-    indicator1 = np.zeros(len(sorted_snp_pos_chr))
-    indicator2 = np.zeros(len(sorted_snp_pos_chr))
-    for seg in IBD1segs_chr:
-        start_idx = np.searchsorted(sorted_snp_pos_chr, seg[0])
-        end_idx = np.searchsorted(sorted_snp_pos_chr, seg[1])
-        indicator1[start_idx:end_idx+1] += 1
-    
-    for seg in IBD2segs_chr:
-        start_idx = np.searchsorted(sorted_snp_pos_chr, seg[0])
-        end_idx = np.searchsorted(sorted_snp_pos_chr, seg[1])
-        indicator2[start_idx:end_idx+1] += 1
-    
-    #calculate IBD1sum and IBD2sum
-    bool_array1 = (indicator1 != 0).astype(np.int32)
-    bool_array2 = (indicator2 != 0).astype(np.int32)
-    seg_array1 = bool_array1*sorted_snp_pos_chr
-    seg_array2 = bool_array2*sorted_snp_pos_chr
+    # a segment covers the markers from the first one at or after its start to the first one at or after its end;
+    # coverage (number of sib pairs IBD1/IBD2 at a marker) is constant between the breakpoints where segments
+    # start or stop covering markers, so it is counted on those runs of markers rather than marker by marker
+    num_markers = len(sorted_snp_pos_chr)
+    covered = []
+    for segs in [IBD1segs_chr, IBD2segs_chr]:
+        segs = np.array(segs, dtype=np.float64).reshape(-1, 2)
+        start_idx = np.searchsorted(sorted_snp_pos_chr, segs[:, 0])
+        end_idx = np.minimum(np.searchsorted(sorted_snp_pos_chr, segs[:, 1]) + 1, num_markers)
+        keep = end_idx > start_idx
+        covered.append((start_idx[keep], end_idx[keep]))
+    breakpoints = np.unique(np.concatenate([[0, num_markers]] + [idx for segs in covered for idx in segs]))
+    coverage = []
+    for start_idx, end_idx in covered:
+        change = np.zeros(len(breakpoints), dtype=np.int64)
+        np.add.at(change, np.searchsorted(breakpoints, start_idx), 1)
+        np.add.at(change, np.searchsorted(breakpoints, end_idx), -1)
+        coverage.append(np.cumsum(change)[:-1])
+    indicator1, indicator2 = coverage
+
     # All siblings IBD2 -> only half of the parental genome transmitted
     # at least two sibs IBD0 -> all of the parental genome transmitted
     # the rest? not sure, use 0.75 as an approximation
 
     #calculate regions where only half the parental genome is transmitted
-    sum_single_copy = sumup((indicator2 == num_sibs*(num_sibs-1)/2)*sorted_snp_pos_chr) 
+    sum_single_copy = coveredLength(sorted_snp_pos_chr, breakpoints, indicator2 == num_sibs*(num_sibs-1)/2)
     indicator3 = indicator2 + indicator1
-    sum_both_copies = sumup((indicator3 < num_sibs*(num_sibs-1)/2)*sorted_snp_pos_chr)
+    sum_both_copies = coveredLength(sorted_snp_pos_chr, breakpoints, indicator3 < num_sibs*(num_sibs-1)/2)
     #print(f'single copy interval: {interval1}')
     #print(f'both copies interval: {interval2}')
     return sum_single_copy, sum_both_copies
 
-@jit(parallel=True, nopython=True)
-def sumup(seg_array):
-    sum = 0
-    head = seg_array[0] if seg_array[0] > 0 else -1
-    for i in np.arange(1, len(seg_array)):
-        if seg_array[i] != 0 and seg_array[i-1] != 0:
-            sum += seg_array[i] - seg_array[i-1]
-    return sum
+def coveredLength(sorted_snp_pos_chr, breakpoints, mask):
+    # genetic length spanned by the markers in the runs breakpoints[k]:breakpoints[k+1] where mask[k], summed over
+    # each block of consecutive such markers from its first to its last marker; a marker at position 0 is
+    # never part of a block
+    edges = np.diff(np.concatenate([[False], mask, [False]]).astype(np.int8))
+    block_starts = breakpoints[:-1][edges[:-1] == 1]
+    block_ends = breakpoints[1:][edges[1:] == -1]
+    zero_start, zero_end = np.searchsorted(sorted_snp_pos_chr, 0.0), np.searchsorted(sorted_snp_pos_chr, 0.0, side='right')
+    if zero_end > zero_start:
+        # split the blocks around the markers at position 0
+        block_starts, block_ends = np.concatenate([block_starts, np.maximum(block_starts, zero_end)]), \
+                                   np.concatenate([np.minimum(block_ends, zero_start), block_ends])
+    keep = block_ends - block_starts > 1
+    return np.sum(sorted_snp_pos_chr[block_ends[keep] - 1] - sorted_snp_pos_chr[block_starts[keep]])
 
 def getInferredWithRel(total_IBD, pct_par, pct_par_rel):
     # using total length of IBD (in cM) and expected percentage of parent genome present in sibling set or percentage of grandparent genome present in sib + aunt/uncle set, calculate estimated K
@@ -983,10 +1111,67 @@ def getExpectedPar(num_sibs):
     return (1.0-1.0/2.0**num_sibs)
 
 
+class FamilyPairIBD(object):
+    # the parts of combineBothGPsKeepProportionOnlyExpectation that only depend on the IBD segments of two groups
+    # of relatives (sib1+avunc1 and sib2+avunc2), not on the degrees in all_rel; each is computed the first time
+    # it is needed and then kept, so the iterations of runDRUID's convergence loop only redo the rest
+    def __init__(self, sib1, avunc1, sib2, avunc2, all_segs, genome, accu):
+        self.sib1 = sib1
+        self.avunc1 = avunc1
+        self.sib2 = sib2
+        self.avunc2 = avunc2
+        self.all_segs = all_segs
+        self.genome = genome
+        self.accu = accu
+        self.ibd_lengths = None
+        self.ibd011_length = None
+
+    def lengths(self):
+        # result of getSiblingRelativeFamIBDLengthIBD2
+        if self.ibd_lengths is None:
+            self.ibd_lengths = getSiblingRelativeFamIBDLengthIBD2(self.sib1, self.sib2, self.avunc1, self.avunc2,
+                                                                  self.all_segs, self.genome, self.accu)
+        return self.ibd_lengths
+
+    def ibd011(self):
+        # total length of the IBD011 overlaps between the two groups (0 if one side has aunts/uncles and the other not)
+        if self.ibd011_length is None:
+            sib1, avunc1, sib2, avunc2, all_segs = self.sib1, self.avunc1, self.sib2, self.avunc2, self.all_segs
+            IBD2 = 0
+            if len(avunc1) and len(avunc2):
+                sibseg = collectIBDsegments(avunc1, all_segs)
+                sibsib = collectIBDsegmentsSibsAvuncularCombine(avunc1, avunc2, all_segs)
+                IBD011 = findOverlap(sibseg, sibsib, 0, 1, 1, 0.5)
+                if len(sib2) > 1:  # could be the case that we have one sib and his/her aunts/uncles
+                    sibseg2 = collectIBDsegments(avunc2, all_segs)
+                    sibsib2 = collectIBDsegmentsSibsAvuncularCombine(avunc2, avunc1, all_segs)
+                    IBD011_2 = findOverlap(sibseg2, sibsib2, 0, 1, 1, 0.5)
+                    for chr in range(self.genome.num_chrs):
+                        IBD011[chr] += IBD011_2[chr]
+                        IBD011[chr] = mergeIntervals(IBD011[chr])
+                IBD2 = getTotalLength(IBD011)
+            # TODO: if avunc1 or avunc2 have data, want to compare them with the sibs from the other side
+            elif not len(avunc1) and not len(avunc2):
+                sibseg = collectIBDsegments(sib1, all_segs)
+                sibsib = collectIBDsegmentsSibsAvuncularCombine(sib1, sib2, all_segs)
+                IBD011 = findOverlap(sibseg, sibsib, 0, 1, 1, 0.5)
+                if len(sib2) > 1: #could be the case that we have one sib and his/her aunts/uncles
+                    sibseg2 = collectIBDsegments(sib2, all_segs)
+                    sibsib2 = collectIBDsegmentsSibsAvuncularCombine(sib2, sib1, all_segs)
+                    IBD011_2 = findOverlap(sibseg2, sibsib2, 0, 1, 1, 0.5)
+                    for chr in range(self.genome.num_chrs):
+                        IBD011[chr] += IBD011_2[chr]
+                        IBD011[chr] = mergeIntervals(IBD011[chr])
+                IBD2 = getTotalLength(IBD011)
+            self.ibd011_length = IBD2
+        return self.ibd011_length
+
+
 def combineBothGPsKeepProportionOnlyExpectation(sib1, avunc1, pc1, sib2, avunc2, pc2, all_rel, \
-                all_segs, rel_graph, sorted_snp_pos, accu, mean_ibd_amount):
+                all_segs, rel_graph, genome, accu, mean_ibd_amount, family_ibd=None):
 # perform ancestral genome reconstruction between two groups of related individuals (sib1+avunc1 and sib2+avunc2)
 # infers relatedness between all individuals within the two groups
+# family_ibd: FamilyPairIBD of the two groups, to reuse its segment computations across calls
     # TODO! use any neice/nephews of sib1, sib2 as well
     # TODO: handle twins in this?
     if len(sib1) == 1 and len(sib2) == 1 and len(avunc1) == 0 and len(avunc2) == 0:
@@ -1000,8 +1185,9 @@ def combineBothGPsKeepProportionOnlyExpectation(sib1, avunc1, pc1, sib2, avunc2,
 
     # returns total length of genome IBD between sibandav and sibandav_rel, number of sibs in sib1 with IBD segments, 
     # number of sibs in sib2 with IBD segments
-    tmpsibav, prop_sib1, prop_sib2, prop_av1, prop_av2, sib1_len, sib2_len, av1_len, av2_len = \
-        getSiblingRelativeFamIBDLengthIBD2(sib1, sib2, avunc1, avunc2, all_segs, sorted_snp_pos, accu)
+    if family_ibd is None:
+        family_ibd = FamilyPairIBD(sib1, avunc1, sib2, avunc2, all_segs, genome, accu)
+    tmpsibav, prop_sib1, prop_sib2, prop_av1, prop_av2, sib1_len, sib2_len, av1_len, av2_len = family_ibd.lengths()
 
     #MY MODIFICATION STARTS HERE
 
@@ -1066,10 +1252,10 @@ def combineBothGPsKeepProportionOnlyExpectation(sib1, avunc1, pc1, sib2, avunc2,
             + mean_ibd_amount*prop_sib1*prop_sib2
     if d:
         print(f'd={d}')
-        print(sib1)
-        print(avunc1)
-        print(sib2)
-        print(avunc2)
+        print(set(map(samples.name, sib1)))
+        print(set(map(samples.name, avunc1)))
+        print(set(map(samples.name, sib2)))
+        print(set(map(samples.name, avunc2)))
     tmpsibav = max(0, tmpsibav-adj)
     #MY MODIFICATION ENDS HERE
 
@@ -1143,31 +1329,7 @@ def combineBothGPsKeepProportionOnlyExpectation(sib1, avunc1, pc1, sib2, avunc2,
 
     IBD2 = 0
     if bothSides and estimated_exp != 1 and K_exp > 1/2.0**(9.0/2):  #check for IBD2 if both sides are being reconstructed, might be reconstructing two sibs; K_exp is 3rd degree or closer
-        if len(avunc1) and len(avunc2):
-            sibseg = collectIBDsegments(avunc1, all_segs)
-            sibsib = collectIBDsegmentsSibsAvuncularCombine(avunc1, avunc2, all_segs)
-            IBD011 = findOverlap(sibseg, sibsib, 0, 1, 1, 0.5)
-            if len(sib2) > 1:  # could be the case that we have one sib and his/her aunts/uncles
-                sibseg2 = collectIBDsegments(avunc2, all_segs)
-                sibsib2 = collectIBDsegmentsSibsAvuncularCombine(avunc2, avunc1, all_segs)
-                IBD011_2 = findOverlap(sibseg2, sibsib2, 0, 1, 1, 0.5)
-                for chr in range(num_chrs):
-                    IBD011[chr] += IBD011_2[chr]
-                    IBD011[chr] = mergeIntervals(IBD011[chr])
-            IBD2 = getTotalLength(IBD011)
-        # TODO: if avunc1 or avunc2 have data, want to compare them with the sibs from the other side
-        elif not len(avunc1) and not len(avunc2):
-            sibseg = collectIBDsegments(sib1, all_segs)
-            sibsib = collectIBDsegmentsSibsAvuncularCombine(sib1, sib2, all_segs)
-            IBD011 = findOverlap(sibseg, sibsib, 0, 1, 1, 0.5)
-            if len(sib2) > 1: #could be the case that we have one sib and his/her aunts/uncles
-                sibseg2 = collectIBDsegments(sib2, all_segs)
-                sibsib2 = collectIBDsegmentsSibsAvuncularCombine(sib2, sib1, all_segs)
-                IBD011_2 = findOverlap(sibseg2, sibsib2, 0, 1, 1, 0.5)
-                for chr in range(num_chrs):
-                    IBD011[chr] += IBD011_2[chr]
-                    IBD011[chr] = mergeIntervals(IBD011[chr])
-            IBD2 = getTotalLength(IBD011)
+        IBD2 = family_ibd.ibd011()
 
         if proportion_par_exp != 0:
             IBD2 = IBD2 / proportion_par_exp
@@ -1181,7 +1343,7 @@ def combineBothGPsKeepProportionOnlyExpectation(sib1, avunc1, pc1, sib2, avunc2,
         if IBD2 != 0:
             # Note: this counts IBD1 with the IBD2 via the fact that we only count IBD2 as if it
             # were IBD1
-            estimated_exp = getInferredFromK(K_exp + IBD2 / total_genome / 2.0)
+            estimated_exp = getInferredFromK(K_exp + IBD2 / genome.total_genome / 2.0)
 
     result = []
     if estimated_exp >= 0:
@@ -1229,6 +1391,68 @@ def combineBothGPsKeepProportionOnlyExpectation(sib1, avunc1, pc1, sib2, avunc2,
 
     return result
 
+class CombineCache(object):
+    # results of combineBothGPsKeepProportionOnlyExpectation by family sets (sib1, avunc1, pc1, sib2, avunc2, pc2),
+    # least recently used dropped first
+    # apart from the sets, a result only depends on the degrees in all_rel of the pairs between the two sides,
+    # so invalidatePair must be called whenever one of those degrees changes
+    def __init__(self, max_size=COMBINE_CACHE_SIZE):
+        self.max_size = max_size
+        self.results = OrderedDict() #key -> result
+        self.keys_of = {} #ind -> set of keys of the results with ind on one of the sides
+        self.hits = self.misses = 0
+
+    def key(self, sib1, avunc1, pc1, sib2, avunc2, pc2):
+        return tuple(frozenset(inds) for inds in (sib1, avunc1, pc1, sib2, avunc2, pc2))
+
+    def get(self, key):
+        # copy of the cached result for key, None if there is none
+        result = self.results.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.results.move_to_end(key)
+        return [list(resu) for resu in result]
+
+    def put(self, key, result):
+        self.results[key] = [list(resu) for resu in result]
+        for ind in key[0] | key[1] | key[3] | key[4]:
+            self.keys_of.setdefault(ind, set()).add(key)
+        if len(self.results) > self.max_size:
+            self.remove(next(iter(self.results)))
+
+    def remove(self, key):
+        del self.results[key]
+        for ind in key[0] | key[1] | key[3] | key[4]:
+            keys = self.keys_of[ind]
+            keys.discard(key)
+            if not len(keys):
+                del self.keys_of[ind]
+
+    def invalidatePair(self, ind1, ind2):
+        # drop the results that may have read the degree of ind1 and ind2
+        if ind1 in self.keys_of and ind2 in self.keys_of:
+            for key in self.keys_of[ind1] & self.keys_of[ind2]:
+                self.remove(key)
+
+
+combine_cache = CombineCache()
+convergence_counts = Counter() #number of iterations runDRUID's convergence loop took per family pair, 0 if it did not converge
+
+
+def cachedCombineBothGPs(sib1, avunc1, pc1, sib2, avunc2, pc2, all_rel, all_segs, rel_graph, genome, accu, mean_ibd_amount,
+                         family_ibd=None):
+    # combineBothGPsKeepProportionOnlyExpectation, with results kept in combine_cache
+    key = combine_cache.key(sib1, avunc1, pc1, sib2, avunc2, pc2)
+    result = combine_cache.get(key)
+    if result is None:
+        result = combineBothGPsKeepProportionOnlyExpectation(sib1, avunc1, pc1, sib2, avunc2, pc2, all_rel, all_segs,
+                                                             rel_graph, genome, accu, mean_ibd_amount, family_ibd)
+        combine_cache.put(key, result)
+    return result
+
+
 def checkRelevantAuntsUncles(sibset1, sibset2, avunc1_bothsides, avunc2_bothsides, par1, par2, all_rel):
     # check whether aunt/uncle should be included in analysis
     avunc1 = set()
@@ -1468,14 +1692,12 @@ def alter_likelihood_t(ibd_list, ibd_isCensored, C):
 #    #print(results, flush=True)
 #    return results[d, a, n_p], d, a, n_p
 
-def getAllRel(results_file, inds_file, mean_ibd_amount, total_genome):
+def getAllRel(results_file, inds_file, mean_ibd_amount, total_genome, cache_dir='', min_K=0):
     # read in results file:
-    # all_rel: dict of ind1, dict of ind2, list of [IBD1, IBD2, K, D]
+    # all_rel: PairTable of [IBD1, IBD2, K, D] per pair; only pairs of individuals in inds_file (if given)
+    # with kinship coefficient >= min_K are kept
     # store pairwise relatedness information
-    global inds
-    first = [] #list of first degree relative pairs according to Refined IBD results
-    second = [] #list of second degree relative pairs according to Refined IBD results
-    third = [] #list of third degree relative pairs according to Refined IBD results
+    global inds, samples
     inds = set()
     if inds_file != '':
         with open(inds_file,'r') as file:
@@ -1484,36 +1706,42 @@ def getAllRel(results_file, inds_file, mean_ibd_amount, total_genome):
                 if len(l):
                     inds.add(l[0])
 
-    all_rel = {}
-    df_ibd12 = pd.read_csv(results_file, sep=r'\s+')
-    for index, row in df_ibd12.iterrows():
-        if inds_file == '':
-            inds.add(row['iid1'])
-            inds.add(row['iid2'])
-        if row['iid1'] in inds and row['iid2'] in inds:
-            ibd1 = row['IBD1_proportion']
-            ibd2 = row['IBD2_proportion']
-
-            #MY MODIFICATION STARTS HERE
-            ibd1 = max(0, ibd1 - mean_ibd_amount / total_genome) #Well, some of the mean_ibd_amount IBD will exhibit in the form of IBD2, need to think about this!
-            #MY MODIFICATION ENDS HERE
-            
-            K = ibd1/4.0 + ibd2/2.0
-            degree = getInferredFromK(K)
-            ind1, ind2 = min(row['iid1'], row['iid2']), max(row['iid1'], row['iid2'])
-            if not ind1 in all_rel.keys():
-                all_rel[ind1] = {} #IBD1, IBD2, K, D
-
-            all_rel[ind1][ind2] = [ibd1,ibd2, K, degree]
-
-            if degree == 1:
-                first.append([ind1,ind2])
-            elif degree == 2:
-                second.append([ind1,ind2])
-            elif degree == 3:
-                third.append([ind1, ind2])
-
-    return [all_rel, inds, first, second,third]
+    def parseIBD12():
+        df_ibd12 = readSampleRows(results_file, ['iid1', 'iid2'], list(inds) if inds_file != '' else None, sep=r'\s+',
+                                  usecols=['iid1', 'iid2', 'IBD1_proportion', 'IBD2_proportion'],
+                                  dtype={'iid1': str, 'iid2': str, 'IBD1_proportion': np.float64, 'IBD2_proportion': np.float64},
+                                  float_precision='round_trip')
+        return { 'iid1' : df_ibd12['iid1'].to_numpy(dtype=str), 'iid2' : df_ibd12['iid2'].to_numpy(dtype=str),
+                 'ibd1' : df_ibd12['IBD1_proportion'].values, 'ibd2' : df_ibd12['IBD2_proportion'].values }
+    ibd12_cols = loadCachedArrays(cache_dir, 'ibd12', [results_file, inds_file], {}, parseIBD12)
+
+    iid1, iid2 = ibd12_cols['iid1'].astype(object), ibd12_cols['iid2'].astype(object)
+    ibd1, ibd2 = ibd12_cols['ibd1'], ibd12_cols['ibd2']
+    if inds_file == '':
+        inds.update(np.column_stack((iid1, iid2)).ravel())
+    # from here on individuals are sample codes, see DRUID_samples.SampleIndex
+    samples = SampleIndex(inds)
+    inds = set(range(len(samples)))
+
+    #MY MODIFICATION STARTS HERE
+    ibd1 = np.maximum(0, ibd1 - mean_ibd_amount / total_genome) #Well, some of the mean_ibd_amount IBD will exhibit in the form of IBD2, need to think about this!
+    #MY MODIFICATION ENDS HERE
+
+    K = ibd1/4.0 + ibd2/2.0
+    if min_K:
+        keep = K >= min_K
+        iid1, iid2, ibd1, ibd2, K = iid1[keep], iid2[keep], ibd1[keep], ibd2[keep], K[keep]
+    degree = getInferredFromKArray(K)
+    codes1, codes2 = samples.codes(iid1), samples.codes(iid2)
+    ind1, ind2 = np.minimum(codes1, codes2), np.maximum(codes1, codes2)
+
+    all_rel = buildPairTable(samples, ind1, ind2, ibd1, ibd2, K, degree)
+
+    first = np.column_stack((ind1, ind2))[degree == 1].tolist() #list of first degree relative pairs according to Refined IBD results
+    second = np.column_stack((ind1, ind2))[degree == 2].tolist() #list of second degree relative pairs according to Refined IBD results
+    third = np.column_stack((ind1, ind2))[degree == 3].tolist() #list of third degree relative pairs according to Refined IBD results
+
+    return [all_rel, samples, inds, first, second,third]
 
 def ersa_bonferroni(all_rel, hapibd_segs, hapibd_isCensored, C, alpha=0.05):
     results = ersa(all_rel, hapibd_segs, hapibd_isCensored, C)
@@ -1521,9 +1749,9 @@ def ersa_bonferroni(all_rel, hapibd_segs, hapibd_isCensored, C, alpha=0.05):
     print(f'total number of comparison for bonf: {total_num_comparison}')
     for pair in results:
         if pair.p < alpha/total_num_comparison:
-            all_rel[pair.ind1][pair.ind2][3] = pair.d
+            all_rel.setD(pair.ind1, pair.ind2, pair.d)
         else:
-            all_rel[pair.ind1][pair.ind2][3] = -1
+            all_rel.setD(pair.ind1, pair.ind2, -1)
 
 def LRT(ibd_list, ibd_isCensored, C):
     tmp =  sorted(zip(ibd_list, ibd_isCensored), key=lambda pair: pair[0])
@@ -1540,19 +1768,17 @@ def ersa(all_rel, hapibd_segs, hapibd_isCensored, C):
     Pair = namedtuple('Pair', 'ind1 ind2 p d')
     with futures.ProcessPoolExecutor() as executor:
         TODO_map = {}
-        for ind1 in all_rel:
-            for ind2 in all_rel[ind1]:
-                degree_from_K = all_rel[ind1][ind2][3]
-                #individuals considered unrelated by kinship coefficient are labelled as -1, so this is fine
-                if  degree_from_K > 3 and ind1 in hapibd_segs and ind2 in hapibd_segs[ind1]:
-                    ibd_list = []
-                    ibd_isCensored = []
-                    for chr in range(num_chrs):
-                        ibd_list.extend(hapibd_segs[ind1][ind2][chr])
-                        ibd_isCensored.extend(hapibd_isCensored[ind1][ind2][chr])
-
-                    future = executor.submit(LRT, ibd_list, ibd_isCensored, C)
-                    TODO_map[future] = (ind1, ind2)
+        #individuals considered unrelated by kinship coefficient are labelled as -1, so this is fine
+        for ind1, ind2, degree_from_K in all_rel.pairs(min_D=3):
+            if ind1 in hapibd_segs and ind2 in hapibd_segs[ind1]:
+                ibd_list = []
+                ibd_isCensored = []
+                for chr in range(num_chrs):
+                    ibd_list.extend(hapibd_segs[ind1][ind2][chr])
+                    ibd_isCensored.extend(hapibd_isCensored[ind1][ind2][chr])
+
+                future = executor.submit(LRT, ibd_list, ibd_isCensored, C)
+                TODO_map[future] = (ind1, ind2)
         done_iter = futures.as_completed(TODO_map)
         for future in done_iter:
             try:
@@ -1571,7 +1797,7 @@ def ersa_FDR(all_rel, hapibd_segs, hapibd_isCensored, C, fdr=0.05):
     print(p_sort)
     p_cut = np.max(p_sort[np.where(q_val <= fdr)])
     for pair in results:
-        all_rel[pair.ind1][pair.ind2][3] = pair.d if pair.p <= p_cut else -1
+        all_rel.setD(pair.ind1, pair.ind2, pair.d if pair.p <= p_cut else -1)
 
 def getSecondDegreeRelatives(rel_graph, second, sibset, par, all_rel):
     # collect all individuals we should check for being aunts/uncles of the sibset
@@ -1599,6 +1825,27 @@ def getSecondDegreeRelatives(rel_graph, second, sibset, par, all_rel):
 
 
 
+def avuncularIBD011(sib1, sib2, candidates, all_segs):
+    # getTotalLength(findOverlap(sibseg, avsib, 0, 1, 1, 0.5)) of sib1 and sib2 with each of candidates as their aunt/uncle,
+    # i.e. the length of the regions where sib1 and sib2 are IBD0 with each other and both IBD1 with the candidate;
+    # computed for all candidates in one sweep, unless some IBD regions are malformed or overlap, which findOverlap
+    # handles in its own way
+    if not len(candidates):
+        return []
+    group, starts, ends = groupedIntervals([getStateTrack(sib1, sib2, all_segs)[0]], num_chrs)
+    tracks = [(np.add.outer(np.arange(len(candidates)) * num_chrs, group).ravel(), np.tile(starts, len(candidates)),
+               np.tile(ends, len(candidates)))] #the IBD0 of sib1 and sib2 once for each candidate
+    for sib in [sib1, sib2]:
+        tracks.append(groupedIntervals([getStateTrack(sib, av, all_segs, ibd0=False)[1] for av in candidates], num_chrs))
+    if not all(isDisjoint(*track) for track in tracks):
+        sibseg = collectIBDsegments([sib1, sib2], all_segs)
+        return [getTotalLength(findOverlap(sibseg, collectIBDsegmentsSibsAvuncular([sib1, sib2], [av], all_segs), 0, 1, 1, 0.5))
+                for av in candidates]
+    group, starts, ends = commonIntervals(tracks)
+    # per candidate, summed one region at a time in chromosome and position order, as getTotalLength does
+    return np.bincount(group // num_chrs, weights=ends - starts, minlength=len(candidates)).tolist()
+
+
 def getAuntsUncles_IBD011_nonoverlapping_pairs(sibset, halfsibs, second, all_rel, all_segs, rel_graph):
     # check whether individuals in list 'second' are likely aunts/uncles of 'sibset' and possibly also 'halfsibs'
     avunc = set()
@@ -1619,12 +1866,11 @@ def getAuntsUncles_IBD011_nonoverlapping_pairs(sibset, halfsibs, second, all_rel
         sibset = list(sibset)
         if len(second):
             for [sib1, sib2] in itertools.combinations(sibset,2):
-                sibseg = collectIBDsegments([sib1,sib2],all_segs)
+                IBD011_all = dict(zip(second, avuncularIBD011(sib1, sib2, second, all_segs)))
                 k = 0
                 while k < len(second):
                     av = second[k]
-                    avsib = collectIBDsegmentsSibsAvuncular([sib1,sib2], [av],all_segs)
-                    IBD011 = getTotalLength(findOverlap(sibseg, avsib, 0, 1, 1, 0.5))
+                    IBD011 = IBD011_all[av]
                     if IBD011 > 50:
                         avunc.add(av)
                         k = k + 1
@@ -1643,17 +1889,17 @@ def getAuntsUncles_IBD011_nonoverlapping_pairs(sibset, halfsibs, second, all_rel
             #check with halfsibs
             second = second_original
             if len(halfsibs):
-                avunc_hs = []
                 for hs in range(0,len(halfsibs)): #hs = index of halfsib set
+                    avunc_hs = set()
                     for [sib1,sib2] in itertools.product(sibset,halfsibs[hs]): #all pairs of [sib, halfsib]
-                        sibseg = collectIBDsegments([sib1,sib2], all_segs)
+                        IBD011_all = dict(zip(second, avuncularIBD011(sib1, sib2, second, all_segs)))
                         k = 0
                         while k < len(second):
                             av = second[k]
-                            avsib = collectIBDsegmentsSibsAvuncular([sib1,sib2], [av], all_segs)
-                            IBD011 = getTotalLength(findOverlap(sibseg, avsib, 0, 1, 1, 0.5))
+                            IBD011 = IBD011_all[av]
                             if IBD011 > 50:
                                 avunc_hs.add(av)
+                                k = k + 1
                                 # avsibs = getSibsFromGraph(rel_graph, av)
                                 # second.remove(av)
                                 # for avsib in avsibs:
@@ -1665,8 +1911,7 @@ def getAuntsUncles_IBD011_nonoverlapping_pairs(sibset, halfsibs, second, all_rel
                                 break
                             else:
                                 k = k + 1
-                    if len(avunc_hs):
-                        avunc_hs_all.append(avunc_hs)
+                    avunc_hs_all.append(avunc_hs) #avunc_hs_all[hs] goes with halfsibs[hs]
 
 
 
@@ -1744,13 +1989,190 @@ def printResult(res, outfile):
         res[2] = 'UN'
         res[3] = 'UN'
     res[0], res[1] = min(res[0], res[1]), max(res[0], res[1])
-    outfile.write("\t".join(map(str,res))+'\n')
-
-def runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile, snp_map, accu, mean_ibd_amount):
-    checked = set()
-    for [ind1,ind2] in itertools.combinations(inds,2): #test each pair of individuals
-        pair_name = getPairName(ind1, ind2)
-        if pair_name in checked:
+    outfile.write("\t".join([samples.name(res[0]), samples.name(res[1])] + list(map(str,res[2:])))+'\n')
+
+def sparsePairs(rel_graph, all_rel, inds):
+    # pairs of inds that are in the pair table (share IBD) or are in the same connected part of rel_graph,
+    # in order of pair key; all other pairs have neither IBD nor a graph path and are left unrelated
+    keys = [all_rel.keys, np.fromiter(all_rel.added, dtype=np.int64, count=len(all_rel.added))]
+    for component in nx.weakly_connected_components(rel_graph):
+        members = np.array(sorted(component), dtype=np.int64)
+        first, second = np.triu_indices(len(members), 1)
+        keys.append(packPairKeys(members[first], members[second]))
+    keys = np.unique(np.concatenate(keys))
+
+    in_inds = np.zeros(len(all_rel.samples), dtype=bool)
+    in_inds[list(inds)] = True
+    ind1 = keys >> 32
+    ind2 = keys & 0xffffffff
+    keep = in_inds[ind1] & in_inds[ind2]
+    return zip(ind1[keep].tolist(), ind2[keep].tolist())
+
+
+GENERATIONS_UP = {'C': 1, 'NN': 1, 'GC': 2} #edge types from ind to an older relative, and how many generations up it is
+
+
+def generationDepth(rel_graph, ind, depth):
+    # number of generations of ind's ancestors (parents, grandparents, aunts/uncles) in rel_graph; memoized in depth
+    if ind in depth:
+        return depth[ind]
+    depth[ind] = 0 #guards against cycles in inconsistent graphs
+    deepest = 0
+    for relative, edge in rel_graph[ind].items():
+        generations = GENERATIONS_UP.get(edge['type'], 0)
+        if generations:
+            deepest = max(deepest, generations + generationDepth(rel_graph, relative, depth))
+    depth[ind] = deepest
+    return deepest
+
+
+def familyClusters(rel_graph, inds):
+    # inds grouped by connected part of rel_graph (singletons for inds not in the graph), larger families first,
+    # and within a family from the oldest generation down
+    depth = {}
+    clusters = []
+    in_graph = set()
+    for component in nx.weakly_connected_components(rel_graph):
+        members = [ind for ind in component if ind in inds]
+        in_graph.update(component)
+        if len(members):
+            members.sort(key=lambda ind: (generationDepth(rel_graph, ind, depth), ind))
+            clusters.append(members)
+    clusters.sort(key=lambda members: (-len(members), min(members)))
+    clusters.extend([ind] for ind in sorted(inds) if ind not in in_graph)
+    return clusters
+
+
+def scheduledPairs(clusters, candidates=None):
+    # order of the pairs compared by runDRUID when scheduling by family (see familyClusters):
+    # - first the pairs within each family, oldest generation first, so the graph resolves them directly before
+    #   anything is propagated to them
+    # - then each pair of families in turn, youngest generation first: moving up from them through the graph
+    #   resolves (and marks as checked) the pairs of their older relatives in the same reconstruction
+    # candidates restricts the pairs to an iterable of (ind1, ind2), e.g. sparsePairs; pairs are still given as
+    # (lower code, higher code), as printed relationship types depend on the order
+    if candidates is None:
+        for members in clusters:
+            for ind1, ind2 in itertools.combinations(members, 2):
+                yield min(ind1, ind2), max(ind1, ind2)
+        for c1 in range(len(clusters)):
+            for c2 in range(c1 + 1, len(clusters)):
+                for ind1, ind2 in itertools.product(reversed(clusters[c1]), reversed(clusters[c2])):
+                    yield min(ind1, ind2), max(ind1, ind2)
+        return
+
+    position = {}
+    for c, members in enumerate(clusters):
+        for rank, ind in enumerate(members):
+            position[ind] = (c, rank)
+    def pairOrder(pair):
+        first, second = sorted((position[pair[0]], position[pair[1]]))
+        if first[0] == second[0]:
+            return False, first[0], first[0], first[1], second[1]
+        return True, first[0], second[0], -first[1], -second[1]
+    yield from sorted(candidates, key=pairOrder)
+
+
+druid_state = None #what runDRUIDByComponent shares with the workers it forks
+
+
+def relatednessComponents(rel_graph, all_rel, inds):
+    # inds grouped by connected component of the graph of pairs in the pair table (sharing IBD) and edges of
+    # rel_graph, each component sorted, components in order of their first member;
+    # no pair within one component is affected by the inference of pairs within another
+    num_samples = len(all_rel.samples)
+    keys = np.concatenate([all_rel.keys, np.fromiter(all_rel.added, dtype=np.int64, count=len(all_rel.added))])
+    edges = np.array(list(rel_graph.edges()), dtype=np.int64).reshape(-1, 2)
+    ind1 = np.concatenate([keys >> 32, edges[:, 0]])
+    ind2 = np.concatenate([keys & 0xffffffff, edges[:, 1]])
+    graph = coo_matrix((np.ones(len(ind1), dtype=np.int8), (ind1, ind2)), shape=(num_samples, num_samples))
+    _, labels = connected_components(graph, directed=False)
+
+    members = np.array(sorted(inds), dtype=np.int64)
+    order = np.argsort(labels[members], kind='stable')
+    members = members[order]
+    _, first, counts = np.unique(labels[members], return_index=True, return_counts=True)
+    components = [members[start:start + count].tolist() for start, count in zip(first, counts)]
+    components.sort(key=lambda component: component[0])
+    return components
+
+
+def druidPairs(rel_graph, all_rel, inds, args):
+    # pairs of inds compared by runDRUID, in order, as selected by --sparse and --schedule
+    if args.sparse:
+        pairs = sparsePairs(rel_graph, all_rel, inds)
+    else:
+        pairs = itertools.combinations(inds,2)
+    if args.schedule:
+        pairs = scheduledPairs(familyClusters(rel_graph, inds), pairs if args.sparse else None)
+    return pairs
+
+
+def druidUnitPairs(phase, c):
+    # pairs of a unit of work of runDRUIDByComponent: the pairs within component c (phase 0), or the pairs
+    # between component c and all later components (phase 1)
+    rel_graph, all_rel, all_segs, genome, accu, mean_ibd_amount, args, components = druid_state
+    if phase == 0:
+        return druidPairs(rel_graph, all_rel, set(components[c]), args)
+    return ((min(ind1, ind2), max(ind1, ind2)) for later in components[c+1:]
+            for ind1, ind2 in itertools.product(components[c], later))
+
+
+def runDRUIDUnit(phase, c):
+    # run one unit of work in a worker forked by runDRUIDByComponent; returns the output lines and the
+    # degrees written to the pair table, for the parent to apply
+    rel_graph, all_rel, all_segs, genome, accu, mean_ibd_amount, args, components = druid_state
+    outfile = io.StringIO()
+    all_rel.d_log = []
+    hits, misses, counts = combine_cache.hits, combine_cache.misses, convergence_counts.copy()
+    comparePairs(druidUnitPairs(phase, c), rel_graph, all_rel, all_segs, outfile, genome, accu, mean_ibd_amount, set())
+    return (outfile.getvalue(), all_rel.d_log, combine_cache.hits - hits, combine_cache.misses - misses,
+            convergence_counts - counts)
+
+
+def runDRUIDByComponent(rel_graph, all_rel, inds, all_segs, args, outfile, genome, accu, mean_ibd_amount):
+    # runDRUID with args.threads processes: the pairs within each relatedness component are independent of the
+    # other components, so components are compared in parallel, followed (without --sparse) by the pairs
+    # between components, which only read the degrees inferred within them
+    # workers are forked and share the pair table, segments and graph with this process; their output is written
+    # in component order and their degree updates applied to all_rel, so the output does not depend on the
+    # number of processes
+    global druid_state
+    components = relatednessComponents(rel_graph, all_rel, inds)
+    print(f'{len(components)} relatedness components, comparing them in {args.threads} processes')
+    phases = [[c for c in range(len(components)) if len(components[c]) > 1]]
+    if not args.sparse:
+        phases.append(range(len(components) - 1))
+    for phase, units in enumerate(phases):
+        druid_state = (rel_graph, all_rel, all_segs, genome, accu, mean_ibd_amount, args, components)
+        with futures.ProcessPoolExecutor(args.threads, mp_context=multiprocessing.get_context('fork')) as executor:
+            for lines, d_log, hits, misses, counts in mapInOrder(executor, runDRUIDUnit, ((phase, c) for c in units),
+                                                                 4 * args.threads):
+                outfile.write(lines)
+                for ind1, ind2, D in d_log:
+                    all_rel.setD(ind1, ind2, D)
+                combine_cache.hits += hits
+                combine_cache.misses += misses
+                convergence_counts.update(counts)
+        druid_state = None
+
+
+def runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile, genome, accu, mean_ibd_amount):
+    if args.threads > 1:
+        runDRUIDByComponent(rel_graph, all_rel, inds, all_segs, args, outfile, genome, accu, mean_ibd_amount)
+    else:
+        comparePairs(druidPairs(rel_graph, all_rel, inds, args), rel_graph, all_rel, all_segs, outfile, genome, accu,
+                     mean_ibd_amount, set())
+    print(f'Family reconstruction cache: {combine_cache.hits} hits, {combine_cache.misses} misses')
+    print('Family pairs by iterations to converge: ' + ', '.join(f'{iterations}: {convergence_counts[iterations]}'
+          for iterations in range(1, MAX_ITER + 1)) + f', not converged: {convergence_counts[0]}')
+
+
+def comparePairs(pairs, rel_graph, all_rel, all_segs, outfile, genome, accu, mean_ibd_amount, checked):
+    # infer and print the relationship of each of pairs not yet in checked, and of the relatives resolved with it
+    for [ind1,ind2] in pairs: #test each pair of individuals
+        pair_key = getPairKey(ind1, ind2)
+        if pair_key in checked:
             continue  #already done
 
         #print("Comparing "+ind1+" and "+ind2)
@@ -1763,7 +2185,7 @@ def runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile, snp_map, accu, m
         # FIRST TWO CASES: pair connected via graph -- output the relationship
         if rel_graph.has_edge(ind1, ind2) and (rel_graph.get_edge_data(ind1,ind2)['type'] in ['FS','PC'] or ((len(sib1) > 1 and checkSibs(sib1,ind2, all_rel)) or len(sib1) == 1) and ((len(sib2) > 1 and checkSibs(sib2,ind1, all_rel)) or len(sib2) == 1)):
             # first degree edge:
-            checked.add(pair_name)
+            checked.add(pair_key)
             refined = getPairwiseD(ind1, ind2, all_rel)
             type = rel_graph.get_edge_data(ind1, ind2)['type']
             if type == '1U':
@@ -1773,7 +2195,7 @@ def runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile, snp_map, accu, m
 
         reltype = getRelationship(rel_graph, ind1, ind2)
         if reltype != -1:   # path between the two:
-            checked.add(pair_name)
+            checked.add(pair_key)
             refined = getPairwiseD(ind1, ind2, all_rel)
             printResult([ind1,ind2,reltype,refined, 'graph2'], outfile)
             continue
@@ -1849,7 +2271,7 @@ def runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile, snp_map, accu, m
                 closest_result = [ind1,ind2,1] # siblings
                 # TODO: ideally want to do the closest_result inference for
                 #       all sibs (and twins) of ind1 and ind2
-                (refined, this_pair) = getPairD_w_Name(ind1, ind2, all_rel)
+                (refined, this_pair) = getPairD_w_Key(ind1, ind2, all_rel)
                 if not this_pair in checked:
                     printResult([ind1, ind2, closest_result[2], refined, 'graph3'], outfile)
                     checked.add(this_pair)
@@ -1882,15 +2304,11 @@ def runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile, snp_map, accu, m
                 graphCase = True
             else:
                 # DO THE INFERENCE
-                sorted_snp_pos = {}
-                for chr_name in snp_map.keys():
-                    pos = snp_map[chr_name].values()
-                    sorted_snp_pos[chrom_name_to_idx[chr_name]] = list(sorted(pos))
                 #### might want to call combineBothGPsKeepProportionOnlyExpectation iteratively to update mean_ibd_amount
                 # results_tmp = combineBothGPsKeepProportionOnlyExpectation(sib1, relavunc1, pc1, sib2, relavunc2, \
-                #                             pc2, all_rel, all_segs, rel_graph, sorted_snp_pos, accu, mean_ibd_amount)
+                #                             pc2, all_rel, all_segs, rel_graph, genome, accu, mean_ibd_amount)
                 # for resu in results_tmp:
-                #     this_pair = getPairName(resu[0], resu[1])
+                #     this_pair = getPairKey(resu[0], resu[1])
                 #     if not this_pair in checked:
                 #         resu.append('inferred3')
                 #         # TODO: twins inference
@@ -1898,18 +2316,21 @@ def runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile, snp_map, accu, m
                 #         checked.add(this_pair)
                 prev_results = set()
                 converged = False
+                # the segment-based parts are the same in every iteration, only the degree-based parts change
+                family_ibd = FamilyPairIBD(sib1, relavunc1, sib2, relavunc2, all_segs, genome, accu)
+                pair_names = samples.name(ind1) + ' and ' + samples.name(ind2)
                 for it in range(MAX_ITER):
-                    results_tmp = combineBothGPsKeepProportionOnlyExpectation(
+                    results_tmp = cachedCombineBothGPs(
                         sib1, relavunc1, pc1, sib2, relavunc2, pc2,
-                        all_rel, all_segs, rel_graph, sorted_snp_pos,
-                        accu, mean_ibd_amount
+                        all_rel, all_segs, rel_graph, genome,
+                        accu, mean_ibd_amount, family_ibd
                     )
 
                     # Compare only (sib_rel, avunc, estimated_out_exp)
                     curr_results = set((resu[0], resu[1], resu[2]) for resu in results_tmp)
 
                     if curr_results == prev_results:
-                        print(f"Converged at iteration {it + 1}")
+                        print(f"Converged at iteration {it + 1} for {pair_names}")
                         converged = True
                         break
 
@@ -1917,17 +2338,17 @@ def runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile, snp_map, accu, m
                     for resu in results_tmp:
                         ind1, ind2 = resu[0], resu[1]
                         ind1, ind2 = min(ind1, ind2), max(ind1, ind2)
-                        ibd1, ibd2, K, D = getIBD1(ind1, ind2, all_rel), getIBD2(ind1, ind2, all_rel), getPairwiseK(ind1, ind2, all_rel), getPairwiseD(ind1, ind2, all_rel)
-                        if not ind1 in all_rel.keys():
-                            all_rel[ind1] = {} #IBD1, IBD2, K, D
-                        all_rel[ind1][ind2] = (ibd1, ibd2, K, resu[2])
+                        if getPairwiseD(ind1, ind2, all_rel) != resu[2]:
+                            combine_cache.invalidatePair(ind1, ind2)
+                        all_rel.setD(ind1, ind2, resu[2])
                         
                     
                 if not converged:
-                    print("Reached maximum iterations without convergence.")
+                    print(f"Reached maximum iterations without convergence for {pair_names}.")
+                convergence_counts[it + 1 if converged else 0] += 1
                 # Output each result only once
                 for resu in results_tmp:
-                    this_pair = getPairName(resu[0], resu[1])
+                    this_pair = getPairKey(resu[0], resu[1])
                     if this_pair not in checked:
                         resu.append('inferred3')
                         printResult(resu, outfile)
@@ -1936,7 +2357,7 @@ def runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile, snp_map, accu, m
             if graphCase:
                 # TODO: ideally want to do the closest_result inference for
                 #       all sibs (and twins) of ind1 and ind2
-                (refined, this_pair) = getPairD_w_Name(ind1, ind2, all_rel)
+                (refined, this_pair) = getPairD_w_Key(ind1, ind2, all_rel)
                 if not this_pair in checked:
                     printResult([ind1, ind2, closest_result[2], refined, 'graph3'], outfile)
                     checked.add(this_pair)
@@ -1968,32 +2389,32 @@ def runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile, snp_map, accu, m
                         total = total + 1
                     else: #gp or gc
                         total = total + 2
-                (refined, this_pair) = getPairD_w_Name(moves_inds1[ii], ind2, all_rel)
+                (refined, this_pair) = getPairD_w_Key(moves_inds1[ii], ind2, all_rel)
                 if not this_pair in checked:
                     printResult([moves_inds1[ii],ind2,total,refined, 'graph+inferred1'], outfile)
                     checked.add(this_pair)
                 #check for close relatives of moves_inds[ii]
                 [sib1, avunc1_bothsides, nn1, par1, child1, pc1, gp1, gc1, halfsib1_sets, twins1] = pullFamily(rel_graph, moves_inds1[ii])
                 for s1 in sib1:
-                    (refined, this_pair) = getPairD_w_Name(s1, ind2, all_rel)
+                    (refined, this_pair) = getPairD_w_Key(s1, ind2, all_rel)
                     if not this_pair in checked:
                         printResult([s1, ind2, total, refined, 'graph+inferred2'], outfile)
                         checked.add(this_pair)
                 sib1.add(moves_inds1[ii])
                 hs1 = checkUseHalfsibs(sib1, halfsib1_sets, ind2, all_rel)
                 for h1 in hs1:
-                    (refined, this_pair) = getPairD_w_Name(h1, ind2, all_rel)
+                    (refined, this_pair) = getPairD_w_Key(h1, ind2, all_rel)
                     if not this_pair in checked:
                         printResult([h1,ind2,total,refined, 'graph+inferred3'], outfile)
                         checked.add(this_pair)
                 for t1 in twins1:
-                    (refined, this_pair) = getPairD_w_Name(t1, ind2, all_rel)
+                    (refined, this_pair) = getPairD_w_Key(t1, ind2, all_rel)
                     if not this_pair in checked:
                         printResult([h1,ind2,total,refined, 'graph+inferredt1'], outfile)
                         checked.add(this_pair)
                 for p in pc1:
                     if not p in moves_inds1:  # if we didn't/won't travel through this relationship
-                        (refined, this_pair) = getPairD_w_Name(p, ind2, all_rel)
+                        (refined, this_pair) = getPairD_w_Key(p, ind2, all_rel)
                         if not this_pair in checked:
                             if total >= 0:
                                 printResult([p,ind2,total+1,refined,'graph+inferred4'], outfile)
@@ -2011,32 +2432,32 @@ def runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile, snp_map, accu, m
                     else: #gp or gc
                         total = total + 2
                 for s1 in sib1:
-                    (refined, this_pair) = getPairD_w_Name(moves_inds2[ii], s1, all_rel)
+                    (refined, this_pair) = getPairD_w_Key(moves_inds2[ii], s1, all_rel)
                     if not this_pair in checked:
                         printResult([s1,moves_inds2[ii],total,refined, 'graph+inferred6'], outfile)
                         checked.add(this_pair)
                     #check for close relatives of moves_inds[ii]
                     [sib2, avunc2_bothsides, nn2, par2, child2, pc2, gp2, gc2, halfsib2_sets, twins2] = pullFamily(rel_graph, moves_inds2[ii])
                     for s2 in sib2:
-                        (refined, this_pair) = getPairD_w_Name(s1, s2, all_rel)
+                        (refined, this_pair) = getPairD_w_Key(s1, s2, all_rel)
                         if not this_pair in checked:
                             printResult([s1,s2,total,refined, 'graph+inferred7'], outfile)
                             checked.add(this_pair)
                     sib2.add(moves_inds2[ii])
                     hs2 = checkUseHalfsibs(sib2, halfsib2_sets, ind1, all_rel)
                     for h2 in hs2:
-                        (refined, this_pair) = getPairD_w_Name(h2, s1, all_rel)
+                        (refined, this_pair) = getPairD_w_Key(h2, s1, all_rel)
                         if this_pair in checked:
                             printResult([s1,h2,total,refined,'graph+inferred8'], outfile)
                             checked.add(this_pair)
                     for t2 in twins2:
-                        (refined, this_pair) = getPairD_w_Name(t2, s1, all_rel)
+                        (refined, this_pair) = getPairD_w_Key(t2, s1, all_rel)
                         if not this_pair in checked:
                             printResult([s1,t2,total,refined, 'graph+inferredt2'], outfile)
                             checked.add(this_pair)
                     for p in pc2:
                         if not p in moves_inds2 and not p == ind2: #if we didn't/won't travel through this relationship
-                            (refined, this_pair) = getPairD_w_Name(p, s1, all_rel)
+                            (refined, this_pair) = getPairD_w_Key(p, s1, all_rel)
                             if not this_pair in checked:
                                 if total >= 0:
                                     printResult([s1, p, total+1, refined, 'graph+inferred9'], outfile)
@@ -2059,7 +2480,7 @@ def runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile, snp_map, accu, m
                                 total = total + 1
                             else:
                                 total = total + 2
-                        (refined, this_pair) = getPairD_w_Name(moves_inds1[i1], moves_inds2[i2], all_rel)
+                        (refined, this_pair) = getPairD_w_Key(moves_inds1[i1], moves_inds2[i2], all_rel)
                         if not this_pair in checked:
                             printResult([moves_inds1[i1],moves_inds2[i2],total,refined, 'graph+inferred10'], outfile)
                             checked.add(this_pair)
@@ -2068,17 +2489,17 @@ def runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile, snp_map, accu, m
                         [sib1, avunc1_bothsides, nn1, par1, child1, pc1, gp1, gc1, halfsib1_sets, twins1] = pullFamily(rel_graph, moves_inds1[i1])
                         [sib2, avunc2_bothsides, nn2, par2, child2, pc2, gp2, gc2, halfsib2_sets, twins2] = pullFamily(rel_graph, moves_inds2[i2])
                         for s1 in sib1:
-                            (refined, this_pair) = getPairD_w_Name(s1, moves_inds2[i2], all_rel)
+                            (refined, this_pair) = getPairD_w_Key(s1, moves_inds2[i2], all_rel)
                             if not this_pair in checked:
                                 printResult([s1, moves_inds2[i2], total, refined, 'graph+inferred11'], outfile)
                                 checked.add(this_pair)
                         for s2 in sib2:
-                            (refined, this_pair) = getPairD_w_Name(s2, moves_inds1[i1], all_rel)
+                            (refined, this_pair) = getPairD_w_Key(s2, moves_inds1[i1], all_rel)
                             if not this_pair in checked:
                                 printResult([moves_inds1[i1], s2, total, refined, 'graph+inferred12'], outfile)
                                 checked.add(this_pair)
                             for s1 in sib1:
-                                (refined, this_pair) = getPairD_w_Name(s1, s2, all_rel)
+                                (refined, this_pair) = getPairD_w_Key(s1, s2, all_rel)
                                 if not this_pair in checked:
                                     printResult([s1, s2, total, refined, 'graph+inferred13'], outfile)
                                     checked.add(this_pair)
@@ -2087,32 +2508,32 @@ def runDRUID(rel_graph, all_rel, inds, all_segs, args, outfile, snp_map, accu, m
                         hs1 = checkUseHalfsibs(sib1, halfsib1_sets, ind2, all_rel)
                         hs2 = checkUseHalfsibs(sib2, halfsib2_sets, ind1, all_rel)
                         for h1 in hs1:
-                            (refined, this_pair) = getPairD_w_Name(h1, moves_inds2[i2], all_rel)
+                            (refined, this_pair) = getPairD_w_Key(h1, moves_inds2[i2], all_rel)
                             if not this_pair in checked:
                                 printResult([h1, moves_inds2[i2], total, refined, 'graph+inferred14'], outfile)
                                 checked.add(this_pair)
                         for h2 in hs2:
-                            (refined, this_pair) = getPairD_w_Name(h2, moves_ind1[i1], all_rel)
+                            (refined, this_pair) = getPairD_w_Key(h2, moves_ind1[i1], all_rel)
                             if not this_pair in checked:
                                 printResult([moves_inds1[i1], h2, total, refined, 'graph+inferred15'], outfile)
                                 checked.add(this_pair)
                             for h1 in hs1:
-                                (refined, this_pair) = getPairD_w_Name(h1, h2, all_rel)
+                                (refined, this_pair) = getPairD_w_Key(h1, h2, all_rel)
                                 if not this_pair in checked:
                                     printResult([h1,h2,total,refined, 'graph+inferred16'], outfile)
                                     checked.add(this_pair)
                         for t1 in twins1:
-                            (refined, this_pair) = getPairName(t1, moves_inds2[i2], all_rel)
+                            (refined, this_pair) = getPairD_w_Key(t1, moves_inds2[i2], all_rel)
                             if not this_pair in checked:
                                 printResult([t1, moves_inds2[i2], total, refined, 'graph+inferredt3'], outfile)
                                 checked.add(this_pair)
                         for t2 in twins2:
-                            (refined, this_pair) = getPairD_w_Name(t2, moves_inds1[i1], all_rel)
+                            (refined, this_pair) = getPairD_w_Key(t2, moves_inds1[i1], all_rel)
                             if not this_pair in checked:
                                 printResult([moves_inds1[i1], t2, total, refined, 'graph+inferredt4'], outfile)
                                 checked.add(this_pair)
                             for t1 in twins1:
-                                (refined, this_pair) = getPairD_w_Name(t1, t2, all_rel)
+                                (refined, this_pair) = getPairD_w_Key(t1, t2, all_rel)
                                 if not this_pair in checked:
                                     printResult([t1, t2, total, refined, 'graph+inferredt5'], outfile)
                                     checked.add(this_pair)
@@ -0,0 +1,69 @@
+import numpy as np
+from collections import namedtuple
+
+
+class GeneticMap(object):
+    # per-chromosome genetic map held as sorted NumPy arrays of bp and cM
+    # positions that are not map markers are linearly interpolated between the flanking markers
+    def __init__(self, chrom_idx_to_name, bp, cM):
+        self.chrom_idx_to_name = chrom_idx_to_name
+        self.chrom_name_to_idx = { chr_name : chr for chr, chr_name in enumerate(chrom_idx_to_name) }
+        self.bp = bp #list indexed by chromosome index of int64 arrays, sorted
+        self.cM = cM #list indexed by chromosome index of float64 arrays, same order as bp
+
+    def __len__(self):
+        return sum(len(bp) for bp in self.bp)
+
+    def toCM(self, chr_name, bp):
+        # genetic position of one or an array of bp positions on chromosome chr_name
+        chr = self.chrom_name_to_idx[chr_name]
+        return np.interp(bp, self.bp[chr], self.cM[chr])
+
+    def toCMByIndex(self, chrom, bp):
+        # genetic positions of a batch of (chromosome index, bp) positions
+        chrom = np.asarray(chrom)
+        bp = np.asarray(bp)
+        cM = np.empty(len(bp), dtype=np.float64)
+        for chr in np.unique(chrom):
+            mask = chrom == chr
+            cM[mask] = np.interp(bp[mask], self.bp[chr], self.cM[chr])
+        return cM
+
+    def sortedPositions(self):
+        # sorted genetic positions of all markers, as a dict of chromosome index -> array
+        return { chr : np.sort(self.cM[chr]) for chr in range(len(self.cM)) }
+
+
+def buildGeneticMap(chr_names, bp, cM):
+    # group map columns by chromosome (in order of first appearance) and sort each chromosome by bp
+    # a bp listed more than once keeps its last cM, as the old dict-based map did
+    chr_names = np.asarray(chr_names)
+    bp = np.asarray(bp, dtype=np.int64)
+    cM = np.asarray(cM, dtype=np.float64)
+    _, first_seen = np.unique(chr_names, return_index=True)
+    chrom_idx_to_name = [str(chr_names[i]) for i in np.sort(first_seen)]
+    bp_by_chr = []
+    cM_by_chr = []
+    for chr_name in chrom_idx_to_name:
+        rows = np.flatnonzero(chr_names == chr_name)[::-1]
+        chr_bp, last = np.unique(bp[rows], return_index=True)
+        bp_by_chr.append(chr_bp)
+        cM_by_chr.append(cM[rows][last])
+    return GeneticMap(chrom_idx_to_name, bp_by_chr, cM_by_chr)
+
+
+# everything about the genome that the inference needs, built once in getChrInfo and passed explicitly
+# snp_map: GeneticMap; chrom_starts/chrom_ends/chrom_lengths: tuples of cM by chromosome index
+# sorted_snp_pos: tuple, by chromosome index, of read-only sorted arrays of marker positions (cM)
+GenomeContext = namedtuple('GenomeContext', ['snp_map', 'chrom_idx_to_name', 'chrom_name_to_idx', 'num_chrs',
+                                             'chrom_starts', 'chrom_ends', 'chrom_lengths', 'total_genome', 'sorted_snp_pos'])
+
+
+def buildGenomeContext(snp_map, chrom_starts, chrom_ends, total_genome):
+    sorted_snp_pos = []
+    for pos in snp_map.sortedPositions().values():
+        pos.setflags(write=False)
+        sorted_snp_pos.append(pos)
+    return GenomeContext(snp_map, tuple(snp_map.chrom_idx_to_name), snp_map.chrom_name_to_idx, len(snp_map.chrom_idx_to_name),
+                         tuple(chrom_starts), tuple(chrom_ends), tuple(end - start for start, end in zip(chrom_starts, chrom_ends)),
+                         total_genome, tuple(sorted_snp_pos))
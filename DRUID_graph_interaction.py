@@ -1,89 +1,246 @@
 import networkx as nx
+import weakref
 from DRUID_functions import *
 from DRUID_all_rel import *
 
+EDGE_TYPES = ['FS', 'P', 'C', 'PC', 'NN', 'AU', 'GP', 'GC', 'HS', 'DC', 'T', '1U', '2', '-1'] #edge types with a code
+EDGE_OTHER = len(EDGE_TYPES) #code of any other edge type
+PATH_END = EDGE_OTHER + 1 #code standing for the (missing) edge after the last edge of a path
+edge_type_code = { type : code for code, type in enumerate(EDGE_TYPES) }
+
+
+def changesLineage(type1, type2):
+    #whether a path going through an edge of type1 and then one of type2 (possibly) travels to another lineage
+    return (type1 == 'PC' and type2 =='PC') or (type1 == 'P' and type2 == 'PC') or (type1 == 'P' and type2 == 'C') or (type1 == 'GP' and type2 == 'GC') or (type1 == 'P' and type2 == 'GC') or (type1 == 'GP' and type2 == 'C') or (type1 == 'PC' and type2 == 'P') or (type1 == 'C' and type2 == 'P') or (type1 == 'GC' and type2 == 'GP') or (type1 == 'C' and type2 == 'GP') or (type1 == 'GC' and type2 == 'P') or (type1 == 'C' and type2 == 'AU') or (type1 == 'GC' and type2 == 'AU') or (type1 == 'P' and type2 == 'NN') or (type1 == 'GP' and type2 == 'NN')
+
+
+def pathStep(type1, type2):
+    #one step of getRelationship's walk along a path, at an edge of type1 followed by one of type2 (-1 at the
+    #last edge): returns the degrees it adds and the number of edges it moves on, 0 edges if the pair is unrelated
+    # check if we are (possibly) traveling to other lineage, and if so, stop
+    if (type1 == 'P' and type2 == 'C') or (type1 == 'GP' and type2 == 'GC') or (type1 == 'P' and type2 == 'GC') or (type1 == 'GP' and type2 == 'C') or (type1 == 'C' and type2 == 'P') or (type1 == 'GC' and type2 == 'GP') or (type1 == 'C' and type2 == 'GP') or (type1 == 'GC' and type2 == 'P') or (type1 == 'C' and type2 == 'AU') or (type1 == 'GC' and type2 == 'AU') or (type1 == 'P' and type2 == 'NN') or (type1 == 'GP' and type2 == 'NN') or (type1 == 'NN' and type2 == 'AU') or (type1 == 'AU' and type2 == 'NN'):
+        return 0, 0
+    elif (type1 == 'AU' and type2 == 'C'):
+        return 0, 0
+    elif type1 in ['2','1U','HS'] or type2 in ['2','1U']:
+        return 0, 0
+    elif type1 in ['FS','P','C']:
+        return 1, 1
+    elif type1 == 'PC': #added 2/16/18
+        return 1, 1
+    elif type1 == 'NN':
+        # an NN edge followed by a final GP edge used to add 4 degrees, but was then stopped as traveling to the other lineage
+        if type2 == 'P' or type2 == 'GP': #traveling to other lineage, stop
+            return 0, 0
+        elif type2 == 'AU' or type2 == 'NN':
+            return 3, 2
+        else:
+            return 0, 0
+    elif type1 == 'AU':
+        if type2 == 'P': #grandparent
+            return 1, 2
+        elif type2 in ['C','GP']: #ind1 and ind2 are cousins or great-grandparent
+            return 2, 2
+        elif type2 in ['GC','HS','DC']: #cousins once removed, half-aunt/uncle, or complex
+            return 3, 2
+        elif type2 == 'NN': #great-aunt/uncle
+            return 3, 2
+        elif type2 == '-1':
+            return 3, 2
+        elif type2 == 'AU': #cousin
+            return 3, 2
+        return 0, 2
+    else:
+        return 0, 0
+
+
+def compilePathTables():
+    #evaluate changesLineage and pathStep for every pair of edge type codes, so walking a path is a table lookup per edge
+    types = EDGE_TYPES + [None, -1] #None stands for any type not in EDGE_TYPES, -1 for the end of the path
+    lineage_change = [[changesLineage(type1, type2) for type2 in types] for type1 in types]
+    steps = [[pathStep(type1, type2) for type2 in types] for type1 in types]
+    step_degrees = [[degrees for degrees, edges in row] for row in steps]
+    step_edges = [[edges for degrees, edges in row] for row in steps]
+    return lineage_change, step_degrees, step_edges
+
+
+#tables indexed by [code of an edge type][code of the next edge type]
+LINEAGE_CHANGE, PATH_STEP_DEGREES, PATH_STEP_EDGES = compilePathTables()
+
+
+def pathEdgeCodes(tmp_graph, path):
+    #edge type codes of the edges along path
+    return [edge_type_code.get(tmp_graph[path[i]][path[i+1]]['type'], EDGE_OTHER) for i in range(len(path)-1)]
+
+
 def checkChangeLineage(tmp_graph,path):
     if len(path) > 2:
-        for i in range(0,len(path)-2):
-            indfirst = path[i]
-            indsecond = path[i+1]
-            indthird = path[i+2]
-            type1 = tmp_graph.get_edge_data(indfirst, indsecond)['type']
-            type2 = tmp_graph.get_edge_data(indsecond, indthird)['type']
-            if (type1 == 'PC' and type2 =='PC') or (type1 == 'P' and type2 == 'PC') or (type1 == 'P' and type2 == 'C') or (type1 == 'GP' and type2 == 'GC') or (type1 == 'P' and type2 == 'GC') or (type1 == 'GP' and type2 == 'C') or (type1 == 'PC' and type2 == 'P') or (type1 == 'C' and type2 == 'P') or (type1 == 'GC' and type2 == 'GP') or (type1 == 'C' and type2 == 'GP') or (type1 == 'GC' and type2 == 'P') or (type1 == 'C' and type2 == 'AU') or (type1 == 'GC' and type2 == 'AU') or (type1 == 'P' and type2 == 'NN') or (type1 == 'GP' and type2 == 'NN'):
-                return True
-        return False
+        return pathChangesLineage(pathEdgeCodes(tmp_graph, path))
     else:
         return False
 
+
+def pathChangesLineage(codes):
+    for i in range(len(codes)-1):
+        if LINEAGE_CHANGE[codes[i]][codes[i+1]]:
+            return True
+    return False
+
+
+def pathDegree(codes):
+    #degree of relatedness along a path of edge type codes, -1 if the path does not make the pair related
+    total = 0 #degree of relatedness
+    i = 0
+    while i < len(codes):
+        next_code = codes[i+1] if i+1 < len(codes) else PATH_END
+        edges = PATH_STEP_EDGES[codes[i]][next_code]
+        if not edges:
+            return -1
+        total += PATH_STEP_DEGREES[codes[i]][next_code]
+        i += edges
+    return total
+
+
+max_path_len = 10 #longest path (number of edges) between two individuals that getRelationship follows; 0 for no limit
+neighborhood_cache = weakref.WeakKeyDictionary() #graph -> dict of ind -> (dict of successor -> its index in graph[ind], list of predecessors)
+
+
+def setMaxPathLength(max_len):
+    global max_path_len
+    max_path_len = max_len
+
+
+def neighborhood(tmp_graph, ind):
+    # successors of ind (with their position in tmp_graph[ind]) and predecessors of ind, cached
+    cache = neighborhood_cache.get(tmp_graph)
+    if cache is None:
+        cache = neighborhood_cache[tmp_graph] = {}
+    neighbors = cache.get(ind)
+    if neighbors is None:
+        neighbors = cache[ind] = ({ succ : i for i, succ in enumerate(tmp_graph[ind]) }, list(tmp_graph.pred[ind]))
+    return neighbors
+
+
+def invalidateNeighborhoods(tmp_graph, ind1, ind2):
+    # forget the cached neighborhoods changed by adding an edge from ind1 to ind2
+    cache = neighborhood_cache.get(tmp_graph)
+    if cache:
+        cache.pop(ind1, None)
+        cache.pop(ind2, None)
+
+
+def shortestPathDistance(tmp_graph, ind1, ind2, max_len):
+    # length of the shortest path from ind1 to ind2 and the distances from ind1 and to ind2 of the nodes seen,
+    # searching from both ends at once and giving up beyond max_len edges (no limit if 0); None if there is no path
+    dist1 = { ind1 : 0 }
+    dist2 = { ind2 : 0 }
+    if ind1 == ind2:
+        return 0, dist1, dist2
+    front1 = [ind1]
+    front2 = [ind2]
+    radius1 = radius2 = 0
+    while len(front1) and len(front2) and (not max_len or radius1 + radius2 < max_len):
+        if len(front1) <= len(front2):
+            radius1 += 1
+            next_front = []
+            for ind in front1:
+                for succ in neighborhood(tmp_graph, ind)[0]:
+                    if not succ in dist1:
+                        dist1[succ] = radius1
+                        next_front.append(succ)
+            front1 = next_front
+            meet = [ind for ind in front1 if ind in dist2]
+        else:
+            radius2 += 1
+            next_front = []
+            for ind in front2:
+                for pred in neighborhood(tmp_graph, ind)[1]:
+                    if not pred in dist2:
+                        dist2[pred] = radius2
+                        next_front.append(pred)
+            front2 = next_front
+            meet = [ind for ind in front2 if ind in dist1]
+        if len(meet):
+            return min(dist1[ind] + dist2[ind] for ind in meet), dist1, dist2
+    return None
+
+
+def shortestPaths(tmp_graph, ind1, ind2, max_len=None):
+    # all shortest paths from ind1 to ind2 of at most max_len edges (default max_path_len), in the same order
+    # as nx.all_shortest_paths, which getRelationship's result depends on
+    # only the nodes on shortest paths are visited: their order in a breadth-first search from ind1 is
+    # recovered from their position in their parents' adjacency, as the search would have found them
+    found = shortestPathDistance(tmp_graph, ind1, ind2, max_path_len if max_len is None else max_len)
+    if found is None:
+        return
+    length, dist1, dist2 = found
+
+    # nodes on shortest paths, by distance from ind1
+    levels = [set() for _ in range(length + 1)]
+    for ind, dist in dist1.items():
+        if dist2.get(ind, -1) == length - dist:
+            levels[dist].add(ind)
+    for ind, dist in dist2.items():
+        if dist1.get(ind, -1) == length - dist:
+            levels[length - dist].add(ind)
+    for level in range(length - 1, -1, -1): #nodes closer to ind1 than the search from ind1 reached
+        for ind in levels[level + 1]:
+            for pred in neighborhood(tmp_graph, ind)[1]:
+                if dist1.get(pred) == level:
+                    levels[level].add(pred)
+    for level in range(1, length + 1): #nodes closer to ind2 than the search from ind2 reached
+        for ind in levels[level - 1]:
+            for succ in neighborhood(tmp_graph, ind)[0]:
+                if dist2.get(succ) == length - level:
+                    levels[level].add(succ)
+
+    # breadth-first order and predecessors on shortest paths
+    order = { ind1 : () }
+    pred = { ind1 : [] }
+    for level in range(1, length + 1):
+        for ind in levels[level]:
+            parents = [par for par in neighborhood(tmp_graph, ind)[1] if par in levels[level - 1]]
+            parents.sort(key=order.get)
+            pred[ind] = parents
+            order[ind] = min(order[par] + (neighborhood(tmp_graph, par)[0][ind],) for par in parents)
+
+    # as networkx builds the paths from the predecessors
+    seen = { ind2 }
+    stack = [[ind2, 0]]
+    top = 0
+    while top >= 0:
+        node, i = stack[top]
+        if node == ind1:
+            yield [p for p, n in reversed(stack[:top + 1])]
+        if len(pred[node]) > i:
+            stack[top][1] = i + 1
+            next = pred[node][i]
+            if next in seen:
+                continue
+            seen.add(next)
+            top += 1
+            if top == len(stack):
+                stack.append([next, 0])
+            else:
+                stack[top][:] = [next, 0]
+        else:
+            seen.discard(node)
+            top -= 1
+
+
 def getRelationship(tmp_graph,ind1,ind2):
     #if ind1 anad ind2 have a path between them, we find their degree of relatedness/relationship type
-    if ind1 in tmp_graph.nodes() and ind2 in tmp_graph.nodes() and nx.has_path(tmp_graph, ind1, ind2):
+    if ind1 in tmp_graph.nodes() and ind2 in tmp_graph.nodes():
         #check all paths because some shortest paths may try to travel through the other lineage
-        paths = nx.all_shortest_paths(tmp_graph,ind1,ind2)
+        paths = shortestPaths(tmp_graph,ind1,ind2)
         for path in paths:
             if len(path) == 2: #path only involves those two individuals
                 return tmp_graph.get_edge_data(ind1,ind2)['type']
-            elif len(path) > 2 and not checkChangeLineage(tmp_graph,path):
-                total = 0 #degree of relatedness
-                i = 2
-                while i <= len(path):
-                    indfirst = path[i-2]
-                    indsecond = path[i-1]
-                    type1 = tmp_graph.get_edge_data(indfirst, indsecond)['type']
-                    if i != len(path):
-                        indthird = path[i]
-                        type2 = tmp_graph.get_edge_data(indsecond,indthird)['type']
-                    else:
-                        type2 = -1
-                    # check if we are (possibly) traveling to other lineage, and if so, stop
-                    if (type1 == 'P' and type2 == 'C') or (type1 == 'GP' and type2 == 'GC') or (type1 == 'P' and type2 == 'GC') or (type1 == 'GP' and type2 == 'C') or (type1 == 'C' and type2 == 'P') or (type1 == 'GC' and type2 == 'GP') or (type1 == 'C' and type2 == 'GP') or (type1 == 'GC' and type2 == 'P') or (type1 == 'C' and type2 == 'AU') or (type1 == 'GC' and type2 == 'AU') or (type1 == 'P' and type2 == 'NN') or (type1 == 'GP' and type2 == 'NN') or (type1 == 'NN' and type2 == 'AU') or (type1 == 'AU' and type2 == 'NN'):
-                        total = -1
-                        i = len(path) + 1
-                    elif (type1 == 'AU' and type2 == 'C'):
-                        total = -1
-                        i = len(path) + 1
-                    elif type1 in ['2','1U','HS'] or type2 in ['2','1U']:
-                        total = -1
-                        i = len(path) + 1
-                    elif type1 in ['FS','P','C']:
-                        total = total + 1
-                        i = i + 1
-                    elif type1 == 'PC': #added 2/16/18
-                        total = total + 1
-                        i = i + 1
-                    elif type1 == 'NN':
-                        if i == len(path) - 1:
-                            if type2 == 'GP':
-                                total = total + 4
-                                i = i + 2
-                        if type2 == 'P' or type2 == 'GP': #traveling to other lineage, stop
-                            total = -1
-                            i = len(path) + 1
-                        elif type2 == 'AU' or type2 == 'NN':
-                            total = total + 3
-                            i = i + 2
-                        else:
-                            total = -1
-                            i = len(path) + 1
-                    elif type1 == 'AU':
-                        if type2 == 'P': #grandparent
-                            total = total + 1
-                        elif type2 in ['C','GP']: #ind1 and ind2 are cousins or great-grandparent
-                            total = total + 2
-                        elif type2 in ['GC','HS','DC']: #cousins once removed, half-aunt/uncle, or complex
-                            total = total + 3
-                        elif type2 == 'NN': #great-aunt/uncle
-                            total = total + 3
-                        elif type2 == '-1':
-                            total = total + 3
-                        elif type2 == 'AU': #cousin
-                            total = total + 3
-                        i = i + 2
-                    else:
-                        total = -1
-                        i = len(path) + 1
-
+            elif len(path) > 2:
+                codes = pathEdgeCodes(tmp_graph, path)
+                if pathChangesLineage(codes):
+                    continue
+                total = pathDegree(codes)
                 if total != 0 and total != -1:
                     return total
         return -1
@@ -278,8 +435,18 @@ def addEdgeType(ind1,ind2,type1,type2,rel_graph):
     if not rel_graph.has_edge(ind1, ind2):
         rel_graph.add_edge(ind1,ind2)
         rel_graph.add_edge(ind2,ind1)
-    rel_graph[ind1][ind2]['type'] = type1
-    rel_graph[ind2][ind1]['type'] = type2
+    setEdgeType(ind1, ind2, type1, rel_graph)
+    setEdgeType(ind2, ind1, type2, rel_graph)
+
+
+def setEdgeType(ind1,ind2,type,rel_graph):
+    #set the type of the edge from ind1 to ind2 (adding it if needed); all changes to edges of a graph that
+    #pullFamily or getRelationship is called on must go through here or addEdgeType, to keep their caches up to date
+    if not rel_graph.has_edge(ind1, ind2):
+        rel_graph.add_edge(ind1,ind2)
+    rel_graph[ind1][ind2]['type'] = type
+    invalidateFamily(rel_graph, ind1, ind2)
+    invalidateNeighborhoods(rel_graph, ind1, ind2)
 
 
 def mean(nums):
@@ -391,9 +558,38 @@ def checkAllNeighborsForSibs(tmp_graph,ind):
     return sibs
 
 
+family_cache = weakref.WeakKeyDictionary() #graph -> dict of ind -> result of pullFamily(graph, ind)
+
+
+def invalidateFamily(tmp_graph, ind1, ind2):
+    #forget the cached families that the edge from ind1 to ind2 is part of: those of ind1, of ind2 (which may
+    #be a new node), and of the individuals with an edge to ind1, whose aunt/uncle and half-sibling sets are
+    #built from ind1's siblings
+    cache = family_cache.get(tmp_graph)
+    if cache:
+        cache.pop(ind1, None)
+        cache.pop(ind2, None)
+        for ind in tmp_graph.predecessors(ind1):
+            cache.pop(ind, None)
+
+
 def pullFamily(tmp_graph,ind):
+    # cached version of findFamily; returns a copy that the caller is free to change
+    cache = family_cache.get(tmp_graph)
+    if cache is None:
+        cache = family_cache[tmp_graph] = {}
+    family = cache.get(ind)
+    if family is None:
+        family = cache[ind] = findFamily(tmp_graph, ind)
+    [sib, avunc_sets, nn, parents, children, pc, grandparents, grandchildren, halfsib_sets, twins] = family
+    return [sib.copy(), [av_sibs.copy() for av_sibs in avunc_sets], nn.copy(), parents.copy(), children.copy(),
+            pc.copy(), grandparents.copy(), grandchildren.copy(), [list(halfsib_set) for halfsib_set in halfsib_sets],
+            twins.copy()]
+
+
+def findFamily(tmp_graph,ind):
     # get all possible connections in graph: siblings, aunts/uncles, parents, children, grandparents, half-siblings, and twins of ind
-    edges = tmp_graph.edges(ind)
+    edges = tmp_graph.edges([ind]) #no edges if ind is not in the graph
     parents = set()
     children = set()
     avunc = set()
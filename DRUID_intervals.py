@@ -0,0 +1,35 @@
+import itertools
+import numpy as np
+from operator import itemgetter
+
+
+def groupedIntervals(tracks, num_chrs):
+    # (group, starts, ends) arrays of the intervals of some dicts (or tuples) of chr -> list of [start, end],
+    # with group = num_chrs * index of the dict + chr
+    segs = [track[chr] for track in tracks for chr in range(num_chrs)]
+    group = np.repeat(np.arange(len(segs)), [len(chr_segs) for chr_segs in segs])
+    bounds = np.fromiter(itertools.chain.from_iterable(map(itemgetter(0, 1), itertools.chain.from_iterable(segs))),
+                         dtype=np.float64)
+    return group, bounds[0::2], bounds[1::2]
+
+
+def isDisjoint(group, starts, ends):
+    # whether grouped intervals, sorted by group and start, are well formed and do not overlap within a group
+    return bool(np.all(ends >= starts) and not np.any((group[1:] == group[:-1]) & (starts[1:] < ends[:-1])))
+
+
+def commonIntervals(interval_lists):
+    # regions covered at once by every one of several lists of (group, starts, ends) arrays, whose intervals are
+    # disjoint within each group (see isDisjoint); the regions are split wherever an interval of a list ends, and
+    # returned as (group, starts, ends) arrays sorted by group and start
+    group = np.concatenate([group for group, starts, ends in interval_lists] * 2)
+    pos = np.concatenate([starts for group, starts, ends in interval_lists] + [ends for group, starts, ends in interval_lists])
+    num_intervals = len(group) // 2
+    # ends sort before starts at the same position, so touching intervals do not overlap
+    step = np.repeat(np.array([1, -1], dtype=np.int8), [num_intervals, num_intervals])
+    order = np.lexsort((step, pos, group))
+    group, pos = group[order], pos[order]
+    count = np.cumsum(step[order])
+    common = np.flatnonzero(count[:-1] == len(interval_lists))
+    common = common[(group[common + 1] == group[common]) & (pos[common + 1] > pos[common])]
+    return group[common], pos[common], pos[common + 1]
@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+
+class SampleIndex(object):
+    # interns sample IDs as dense int32 codes, used in place of the ID strings everywhere after loading
+    # codes are assigned in sorted ID order, so comparing two codes is the same as comparing their IDs;
+    # names maps codes back to IDs and is only needed when writing output
+    def __init__(self, names):
+        self.names = sorted(names)
+        self.name_to_idx = { name : idx for idx, name in enumerate(self.names) }
+        self.index = pd.Index(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.name_to_idx
+
+    def code(self, name):
+        return self.name_to_idx[name]
+
+    def codes(self, names):
+        # int32 codes of an array of IDs, -1 for IDs that are not samples
+        return self.index.get_indexer(np.asarray(names, dtype=object)).astype(np.int32)
+
+    def name(self, code):
+        return self.names[code]
+
+
+def packPairKeys(codes1, codes2):
+    # packed int64 keys (lower code << 32 | higher code) of arrays of unordered sample code pairs
+    codes1 = np.asarray(codes1, dtype=np.int64)
+    codes2 = np.asarray(codes2, dtype=np.int64)
+    return np.minimum(codes1, codes2) << 32 | np.maximum(codes1, codes2)
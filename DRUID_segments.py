@@ -0,0 +1,227 @@
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from DRUID_samples import *
+
+
+class SegmentStore(object):
+    # columnar store of pairwise IBD segments
+    # rows are grouped by canonical pair (ind1 < ind2) with a single sort, so the segments of a pair
+    # are the contiguous rows pair_starts[k]:pair_ends[k] of the typed columns below
+    def __init__(self, samples, pair_keys, pair_starts, pair_ends, chrom, ibd_type, start_cM, end_cM, num_chrs):
+        self.samples = samples #SampleIndex the pair keys refer to
+        self.pair_keys = pair_keys #int64 packed sample code pairs, sorted
+        self.pair_starts = pair_starts #int64, first row of each pair
+        self.pair_ends = pair_ends #int64, one past the last row of each pair
+        self.chrom = chrom #int16 chromosome index
+        self.ibd_type = ibd_type #int8, 0 for IBD1, 1 for IBD2
+        self.start_cM = start_cM #float64
+        self.end_cM = end_cM #float64
+        self.num_chrs = num_chrs
+
+    def __len__(self):
+        return len(self.pair_keys)
+
+    def pairRows(self, ind1, ind2):
+        # return the [start, end) row range holding the segments of sample codes ind1 and ind2, None if they share none
+        key = ind1 << 32 | ind2 if ind1 < ind2 else ind2 << 32 | ind1
+        k = self.pair_keys.searchsorted(key)
+        if k == len(self.pair_keys) or self.pair_keys[k] != key:
+            return None
+        return self.pair_starts[k], self.pair_ends[k]
+
+    def getSegments(self, ind1, ind2):
+        # same layout as the old nested dict: [IBD1, IBD2], each a dict of chr -> list of [startCM, endCM]
+        segs = [ { chr : [] for chr in range(self.num_chrs) } for _ in range(2) ]
+        rows = self.pairRows(ind1, ind2)
+        if rows is None:
+            return segs
+        start, end = rows
+        for chr, ibd_type, start_cM, end_cM in zip(self.chrom[start:end].tolist(), self.ibd_type[start:end].tolist(),
+                                                  self.start_cM[start:end].tolist(), self.end_cM[start:end].tolist()):
+            segs[ibd_type][chr].append([start_cM, end_cM])
+        return segs
+
+    def withSamples(self, samples, keep_pairs=None):
+        # the same store keyed by the codes of another SampleIndex; pairs involving IDs that are
+        # not in samples (or, if given, whose key is not in keep_pairs) are dropped.
+        # Codes of both indices follow ID order, so keys stay sorted
+        pair_keys, keep = recodePairKeys(self.pair_keys, self.samples, samples, keep_pairs)
+        return SegmentStore(samples, pair_keys, self.pair_starts[keep], self.pair_ends[keep],
+                            self.chrom, self.ibd_type, self.start_cM, self.end_cM, self.num_chrs)
+
+    def toArrays(self, prefix=''):
+        # the columns of the store, e.g. for DRUID_cache
+        return { prefix + 'names' : np.array(self.samples.names, dtype=str), prefix + 'pair_keys' : self.pair_keys,
+                 prefix + 'pair_starts' : self.pair_starts, prefix + 'pair_ends' : self.pair_ends, prefix + 'chrom' : self.chrom,
+                 prefix + 'ibd_type' : self.ibd_type, prefix + 'start_cM' : self.start_cM, prefix + 'end_cM' : self.end_cM }
+
+
+def recodePairKeys(pair_keys, old_samples, samples, keep_pairs=None):
+    # translate sorted pair keys from the codes of old_samples to those of samples
+    # returns the kept keys and the mask of kept pairs: both IDs in samples and, if given, the key in keep_pairs
+    recode = samples.codes(old_samples.names)
+    ind1, ind2 = recode[pair_keys >> 32], recode[pair_keys & 0xffffffff]
+    keep = (ind1 >= 0) & (ind2 >= 0)
+    new_keys = packPairKeys(ind1, ind2)
+    if keep_pairs is not None:
+        keep &= np.isin(new_keys, keep_pairs)
+    return new_keys[keep], keep
+
+
+def segmentStoreFromArrays(arrays, num_chrs, prefix=''):
+    # inverse of SegmentStore.toArrays
+    return SegmentStore(SampleIndex(arrays[prefix + 'names'].tolist()), arrays[prefix + 'pair_keys'],
+                        arrays[prefix + 'pair_starts'], arrays[prefix + 'pair_ends'], arrays[prefix + 'chrom'],
+                        arrays[prefix + 'ibd_type'], arrays[prefix + 'start_cM'], arrays[prefix + 'end_cM'], num_chrs)
+
+
+def buildSegmentStore(ids1, ids2, chrom, ibd_type, start_cM, end_cM, num_chrs, samples=None):
+    # group segment columns by canonical pair
+    # ids1/ids2: sample IDs of each segment; chrom: chromosome index; ibd_type: 0 (IBD1) or 1 (IBD2)
+    # samples: SampleIndex containing all IDs; by default the store gets its own SampleIndex of the IDs
+    # it contains, see SegmentStore.withSamples
+    ids1 = np.asarray(ids1, dtype=object)
+    ids2 = np.asarray(ids2, dtype=object)
+    num_segs = len(ids1)
+    if samples is None:
+        codes, names = pd.factorize(np.concatenate([ids1, ids2]), sort=True)
+        samples = SampleIndex(names)
+    else:
+        codes = samples.codes(np.concatenate([ids1, ids2]))
+    keys = packPairKeys(codes[:num_segs], codes[num_segs:])
+
+    # stable, so segments of a pair keep their order in the input
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    pair_keys, pair_starts = np.unique(keys, return_index=True)
+    pair_starts = pair_starts.astype(np.int64)
+
+    return SegmentStore(samples, pair_keys, pair_starts, np.append(pair_starts[1:], num_segs),
+                        np.asarray(chrom, dtype=np.int16)[order],
+                        np.asarray(ibd_type, dtype=np.int8)[order],
+                        np.asarray(start_cM, dtype=np.float64)[order],
+                        np.asarray(end_cM, dtype=np.float64)[order],
+                        num_chrs)
+
+
+class LazySegmentStore(object):
+    # SegmentStore look-alike for large .seg files: only an index from each pair to the byte ranges
+    # (runs of consecutive lines) holding its segments is kept in memory, and a pair's segments are
+    # read from the file when first needed; at most max_pairs parsed pairs are kept, least recently used first out
+    def __init__(self, path, columns, chrom_name_to_idx, samples, pair_keys, pair_starts, pair_ends,
+                 run_offset, run_length, num_chrs, max_pairs):
+        self.path = path
+        self.fd = None #opened on first read; read with os.pread, so forked processes can share it
+        self.columns = columns #field index of ch, ibd_type, startCM and endCM
+        self.chrom_name_to_idx = chrom_name_to_idx
+        self.samples = samples #SampleIndex the pair keys refer to
+        self.pair_keys = pair_keys #int64 packed sample code pairs, sorted
+        self.pair_starts = pair_starts #int64, first run of each pair
+        self.pair_ends = pair_ends #int64, one past the last run of each pair
+        self.run_offset = run_offset #int64 byte offset of each run of lines, grouped by pair
+        self.run_length = run_length #int64 byte length of each run
+        self.num_chrs = num_chrs
+        self.max_pairs = max_pairs
+        self.cache = OrderedDict() #pair key -> list of (IBD type, chr, startCM, endCM)
+
+    def __len__(self):
+        return len(self.pair_keys)
+
+    def readPair(self, k):
+        # parse the segments of the k-th pair from the file
+        chr_col, type_col, start_col, end_col = self.columns
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        segs = []
+        for run in range(self.pair_starts[k], self.pair_ends[k]):
+            for line in os.pread(self.fd, int(self.run_length[run]), int(self.run_offset[run])).split(b'\n'):
+                fields = line.split()
+                if fields:
+                    segs.append((int(fields[type_col][-1:]) - 1, self.chrom_name_to_idx[fields[chr_col].decode()],
+                                 float(fields[start_col]), float(fields[end_col])))
+        return segs
+
+    def getSegments(self, ind1, ind2):
+        # same layout as SegmentStore.getSegments
+        segs = [ { chr : [] for chr in range(self.num_chrs) } for _ in range(2) ]
+        key = ind1 << 32 | ind2 if ind1 < ind2 else ind2 << 32 | ind1
+        pair_segs = self.cache.get(key)
+        if pair_segs is None:
+            k = self.pair_keys.searchsorted(key)
+            if k == len(self.pair_keys) or self.pair_keys[k] != key:
+                return segs
+            pair_segs = self.readPair(k)
+            self.cache[key] = pair_segs
+            if len(self.cache) > self.max_pairs:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        for ibd_type, chr, start_cM, end_cM in pair_segs:
+            segs[ibd_type][chr].append([start_cM, end_cM])
+        return segs
+
+    def withSamples(self, samples, keep_pairs=None):
+        # see SegmentStore.withSamples
+        pair_keys, keep = recodePairKeys(self.pair_keys, self.samples, samples, keep_pairs)
+        return LazySegmentStore(self.path, self.columns, self.chrom_name_to_idx, samples, pair_keys,
+                                self.pair_starts[keep], self.pair_ends[keep], self.run_offset, self.run_length,
+                                self.num_chrs, self.max_pairs)
+
+    def toArrays(self, prefix=''):
+        # the index of the store, e.g. for DRUID_cache
+        return { prefix + 'names' : np.array(self.samples.names, dtype=str), prefix + 'columns' : np.array(self.columns),
+                 prefix + 'pair_keys' : self.pair_keys, prefix + 'pair_starts' : self.pair_starts,
+                 prefix + 'pair_ends' : self.pair_ends, prefix + 'run_offset' : self.run_offset,
+                 prefix + 'run_length' : self.run_length }
+
+
+def lazySegmentStoreFromArrays(arrays, path, chrom_name_to_idx, num_chrs, max_pairs, prefix=''):
+    # inverse of LazySegmentStore.toArrays
+    return LazySegmentStore(path, arrays[prefix + 'columns'].tolist(), chrom_name_to_idx,
+                            SampleIndex(arrays[prefix + 'names'].tolist()), arrays[prefix + 'pair_keys'],
+                            arrays[prefix + 'pair_starts'], arrays[prefix + 'pair_ends'], arrays[prefix + 'run_offset'],
+                            arrays[prefix + 'run_length'], num_chrs, max_pairs)
+
+
+def buildLazySegmentStore(path, chrom_name_to_idx, num_chrs, max_pairs, samples, keep_pairs=None):
+    # scan a .seg file (whitespace separated, with an iid1/iid2/ch/ibd_type/startCM/endCM header) once,
+    # recording for each run of consecutive lines of the same pair its IDs and byte range
+    # only pairs of IDs in samples (and, if given, with keys in keep_pairs) are indexed
+    run_ids1, run_ids2, run_offset, run_length = [], [], [], []
+    with open(path, 'rb') as file:
+        header = file.readline()
+        fields = header.split()
+        id_cols = fields.index(b'iid1'), fields.index(b'iid2')
+        columns = [fields.index(col) for col in (b'ch', b'ibd_type', b'startCM', b'endCM')]
+        offset = len(header)
+        prev_ids = None
+        for line in file:
+            fields = line.split()
+            if fields:
+                ids = fields[id_cols[0]], fields[id_cols[1]]
+                if ids == prev_ids:
+                    run_length[-1] += len(line)
+                else:
+                    run_ids1.append(ids[0])
+                    run_ids2.append(ids[1])
+                    run_offset.append(offset)
+                    run_length.append(len(line))
+                    prev_ids = ids
+            offset += len(line)
+
+    num_runs = len(run_ids1)
+    codes = samples.codes(np.array([id.decode() for id in run_ids1 + run_ids2], dtype=object))
+    keep = (codes[:num_runs] >= 0) & (codes[num_runs:] >= 0)
+    keys = packPairKeys(codes[:num_runs], codes[num_runs:])
+    if keep_pairs is not None:
+        keep &= np.isin(keys, keep_pairs)
+    keys = keys[keep]
+    # stable, so runs of a pair keep their order in the file
+    order = np.argsort(keys, kind='stable')
+    pair_keys, pair_starts = np.unique(keys[order], return_index=True)
+    pair_starts = pair_starts.astype(np.int64)
+    return LazySegmentStore(path, columns, chrom_name_to_idx, samples, pair_keys, pair_starts,
+                            np.append(pair_starts[1:], len(keys)), np.array(run_offset, dtype=np.int64)[keep][order],
+                            np.array(run_length, dtype=np.int64)[keep][order], num_chrs, max_pairs)
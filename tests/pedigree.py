@@ -0,0 +1,111 @@
+# build small simulated pedigrees and write them as DRUID input files (.seg, .ibd12, .map, faminfo)
+# haplotypes are lists (one per chromosome) of (startCM, endCM, founder label) pieces; crossovers only happen at
+# block boundaries, so the IBD of every pair is known exactly
+import itertools
+import os
+import random
+import subprocess
+import sys
+
+NUM_CHRS = 10
+CHR_LEN = 150.0
+BLOCK_LEN = 50.0
+MAP_STEP = 1.0
+DRUID = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'DRUID.py')
+
+
+class Pedigree(object):
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.labels = itertools.count()
+        self.inds = {} #name -> [haplotype 1, haplotype 2]
+        self.genotyped = []
+
+    def founder(self, name, genotyped=True):
+        return self.add(name, [[[(0.0, CHR_LEN, next(self.labels))] for chr in range(NUM_CHRS)] for _ in range(2)],
+                        genotyped)
+
+    def child(self, name, parent1, parent2, genotyped=True):
+        return self.add(name, [self.meiosis(self.inds[parent1]), self.meiosis(self.inds[parent2])], genotyped)
+
+    def add(self, name, haps, genotyped):
+        self.inds[name] = haps
+        if genotyped:
+            self.genotyped.append(name)
+        return name
+
+    def meiosis(self, parent):
+        # transmitted haplotype: each block of each chromosome comes from one of the parent's haplotypes
+        hap = []
+        for chr in range(NUM_CHRS):
+            pieces = []
+            for start in frange(0.0, CHR_LEN, BLOCK_LEN):
+                end = start + BLOCK_LEN
+                for s, e, label in parent[self.rng.getrandbits(1)][chr]:
+                    s, e = max(s, start), min(e, end)
+                    if e > s:
+                        if pieces and pieces[-1][2] == label and pieces[-1][1] == s:
+                            pieces[-1] = (pieces[-1][0], e, label)
+                        else:
+                            pieces.append((s, e, label))
+            hap.append(pieces)
+        return hap
+
+    def ibdRuns(self, ind1, ind2, chr):
+        # IBD1/IBD2 runs of ind1 and ind2 on chr, as [start, end, 1 or 2]
+        shared = [] #(hap of ind1, hap of ind2, start, end)
+        for h1, h2 in itertools.product(range(2), repeat=2):
+            for s1, e1, label1 in self.inds[ind1][h1][chr]:
+                for s2, e2, label2 in self.inds[ind2][h2][chr]:
+                    if label1 == label2 and min(e1, e2) > max(s1, s2):
+                        shared.append((h1, h2, max(s1, s2), min(e1, e2)))
+        points = sorted(set(p for seg in shared for p in seg[2:]))
+        runs = []
+        for start, end in zip(points[:-1], points[1:]):
+            active = set((h1, h2) for h1, h2, s, e in shared if s <= start and e >= end)
+            state = 2 if {(0, 0), (1, 1)} <= active or {(0, 1), (1, 0)} <= active else (1 if active else 0)
+            if runs and runs[-1][2] == state and runs[-1][1] == start:
+                runs[-1][1] = end
+            elif state:
+                runs.append([start, end, state])
+        return runs
+
+    def write(self, prefix, faminfo=()):
+        # write prefix.seg, prefix.ibd12, prefix.map and prefix.faminfo (rows of (ind1, ind2, type))
+        total = NUM_CHRS * CHR_LEN
+        with open(prefix + '.seg', 'w') as seg, open(prefix + '.ibd12', 'w') as ibd12:
+            seg.write('iid1\tiid2\tch\tibd_type\tstartCM\tendCM\n')
+            ibd12.write('iid1\tiid2\tIBD1_proportion\tIBD2_proportion\n')
+            for ind1, ind2 in itertools.combinations(self.genotyped, 2):
+                ibd = [0.0, 0.0]
+                for chr in range(NUM_CHRS):
+                    for start, end, state in self.ibdRuns(ind1, ind2, chr):
+                        seg.write('%s\t%s\t%d\tIBD%d\t%.4f\t%.4f\n' % (ind1, ind2, chr + 1, state, start, end))
+                        ibd[state - 1] += end - start
+                if ibd[0] or ibd[1]:
+                    ibd12.write('%s\t%s\t%.6f\t%.6f\n' % (ind1, ind2, ibd[0] / total, ibd[1] / total))
+        with open(prefix + '.map', 'w') as map_file:
+            for chr in range(NUM_CHRS):
+                for cM in frange(0.0, CHR_LEN + MAP_STEP, MAP_STEP):
+                    map_file.write('%d\t.\t%.4f\t%d\n' % (chr + 1, cM, int(round(cM * 1e6)) + 10000))
+        with open(prefix + '.faminfo', 'w') as fam:
+            for row in faminfo:
+                fam.write('\t'.join(row) + '\n')
+
+
+def frange(start, stop, step):
+    return [start + k * step for k in range(int(round((stop - start) / step)))]
+
+
+def runDRUID(prefix, *args):
+    # run DRUID on the inputs written by Pedigree.write and return the lines of its .DRUID output
+    subprocess.run([sys.executable, DRUID, '-i', prefix + '.ibd12', '-s', prefix + '.seg', '-m', prefix + '.map',
+                    '-o', prefix] + list(args), check=True, cwd=os.path.dirname(DRUID),
+                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    with open(prefix + '.DRUID') as file:
+        return file.read().splitlines()
+
+
+def relationships(lines):
+    # {frozenset of the two individuals : inferred relationship} of DRUID output lines
+    return { frozenset(line.split('\t')[:2]) : line.split('\t')[2] for line in lines if not line.startswith('#') }
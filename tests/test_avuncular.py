@@ -0,0 +1,22 @@
+from pedigree import Pedigree, runDRUID, relationships
+
+
+def halfSibFamily(seed):
+    # A is a full sibling of P; S1 and S2 are children of P and Q, H of P and R, so A is an aunt/uncle of all three
+    ped = Pedigree(seed)
+    for founder in ['G1', 'G2', 'Q', 'R']:
+        ped.founder(founder, genotyped=False)
+    ped.child('P', 'G1', 'G2', genotyped=False)
+    ped.child('A', 'G1', 'G2')
+    ped.child('S1', 'P', 'Q')
+    ped.child('S2', 'P', 'Q')
+    ped.child('H', 'P', 'R')
+    return ped
+
+
+def test_aunt_uncle_of_sibs_and_halfsibs(tmp_path):
+    prefix = str(tmp_path / 'hs')
+    halfSibFamily(1).write(prefix, [('S1', 'S2', 'FS'), ('S1', 'H', 'HS'), ('S2', 'H', 'HS')])
+    rels = relationships(runDRUID(prefix, '-f', prefix + '.faminfo'))
+    for ind in ['S1', 'S2', 'H']:
+        assert rels[frozenset(['A', ind])] == 'AU'
@@ -0,0 +1,35 @@
+import pytest
+
+from pedigree import Pedigree, runDRUID
+
+
+def families(seed, num_families=3):
+    # unrelated three-generation families (with ungenotyped founders) and unrelated individuals, so that
+    # --threads has several relatedness components to compare in parallel
+    ped = Pedigree(seed)
+    for f in range(num_families):
+        fam = 'F%d' % f
+        ped.founder(fam + 'G1', genotyped=False)
+        ped.founder(fam + 'G2')
+        for k in range(3):
+            ped.child(fam + 'K%d' % k, fam + 'G1', fam + 'G2')
+        for k in range(2):
+            ped.founder(fam + 'S%d' % k, genotyped=False)
+            for c in range(2):
+                ped.child(fam + 'K%dc%d' % (k, c), fam + 'K%d' % k, fam + 'S%d' % k)
+        ped.founder(fam + 'T', genotyped=False)
+        ped.child(fam + 'g0', fam + 'K0c0', fam + 'T')
+    for u in range(2):
+        ped.founder('U%d' % u)
+    return ped
+
+
+@pytest.mark.parametrize('extra_args', [[], ['--sparse']])
+def test_threads_output_same_lines(tmp_path, extra_args):
+    # output is written component by component with --threads N > 1, so only the line order may differ from N = 1
+    prefix = str(tmp_path / 'fam')
+    families(0).write(prefix)
+    single = runDRUID(prefix, '--threads', '1', *extra_args)
+    multi = runDRUID(prefix, '--threads', '2', *extra_args)
+    assert single[0] == multi[0] #header
+    assert sorted(single[1:]) == sorted(multi[1:])